@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from collections import OrderedDict
+
+from tabellarius.imap import IMAP
+
+
+class ActionPlan():
+    """
+    Collects the actions to apply to the mails of a mailbox, to execute them in batches instead of one by one
+    """
+
+    def __init__(self, logger, mailbox):
+        self.logger = logger
+        self.mailbox = mailbox
+
+        # (destination, add_flags, set_flags) -> {'uids': [...], 'message_ids': [...]}
+        self.moves = OrderedDict()
+        # flags -> uids
+        self.flags = OrderedDict()
+
+    def __len__(self):
+        return sum(len(mails['uids']) + len(mails['message_ids']) for mails in self.moves.values()) + sum(len(uids) for uids in self.flags.values())
+
+    def move(self, destination, uid=None, message_id=None, add_flags=None, set_flags=None):
+        """
+        Plan to move a mail (by UID or, if unknown, by Message-Id) to another mailbox
+        """
+        if isinstance(add_flags, str):
+            add_flags = [add_flags]
+
+        key = (destination,
+               tuple(add_flags) if add_flags else None,
+               tuple(set_flags) if isinstance(set_flags, list) else None)
+        mails = self.moves.setdefault(key, {'uids': [], 'message_ids': []})
+        if uid is not None:
+            mails['uids'].append(uid)
+        else:
+            mails['message_ids'].append(message_id)
+        return key
+
+    def set_flags(self, uid, flags):
+        """
+        Plan to set the flags of a mail that stays in the mailbox
+        """
+        key = tuple(flags)
+        self.flags.setdefault(key, []).append(uid)
+        return key
+
+    def calls(self):
+        """
+        Return the IMAP method calls [(method name, kwargs)] needed to apply the plan: one STORE per flag set first, then one
+        MOVE (or COPY/STORE) per destination
+        """
+        calls = []
+        if self.flags:
+            calls.append(('set_mailflags_many', {'mailbox': self.mailbox, 'flag_sets': self.flags}))
+
+        for (destination, add_flags, set_flags), mails in self.moves.items():
+            for key in ['uids', 'message_ids']:
+                if mails[key]:
+                    calls.append(('move_mail', {'source': self.mailbox,
+                                                'destination': destination,
+                                                'add_flags': list(add_flags) if add_flags else None,
+                                                'set_flags': list(set_flags) if set_flags is not None else None,
+                                                key: mails[key]}))
+        return calls
+
+    def execute(self, imap):
+        """
+        Apply all planned actions
+        """
+        self.logger.debug('Executing action plan for mailbox {}: {} flag changes, {} moves'.format(
+            self.mailbox, len(self.flags), len(self.moves)))
+
+        moved = OrderedDict((destination, []) for destination, _, _ in self.moves)
+        for method, kwargs in self.calls():
+            result = getattr(imap, method)(**kwargs)
+            if not self.__process_result(method, kwargs, result, moved):
+                return result
+
+        self.moves.clear()
+        self.flags.clear()
+        return IMAP.Retval(True, moved)
+
+    async def execute_async(self, imap):
+        """
+        Apply all planned actions using an asyncio IMAP backend (AsyncIMAP)
+        """
+        self.logger.debug('Executing action plan for mailbox {}: {} flag changes, {} moves'.format(
+            self.mailbox, len(self.flags), len(self.moves)))
+
+        moved = OrderedDict((destination, []) for destination, _, _ in self.moves)
+        for method, kwargs in self.calls():
+            result = await getattr(imap, method)(**kwargs)
+            if not self.__process_result(method, kwargs, result, moved):
+                return result
+
+        self.moves.clear()
+        self.flags.clear()
+        return IMAP.Retval(True, moved)
+
+    def __process_result(self, method, kwargs, result, moved):
+        """
+        Log the result of a call and collect the new UIDs of moved mails
+        """
+        if method == 'move_mail':
+            mails = kwargs.get('uids') or kwargs.get('message_ids')
+            if not result.code:
+                self.logger.error('Failed to move mails {} to {}: {}'.format(mails, kwargs['destination'], result.data))
+                return False
+            self.logger.info('Moved {} mail(s) from {} to {}'.format(len(mails), self.mailbox, kwargs['destination']))
+            if result.data:
+                moved[kwargs['destination']].extend(result.data)
+        elif not result.code:
+            self.logger.error('Failed to set flags on mails {}: {}'.format(dict(self.flags), result.data))
+            return False
+        return True
@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from functools import wraps
+from re import compile as regex_compile
+import asyncio
+import email
+import ssl
+
+import aioimaplib
+from imapclient.imap_utf7 import decode as decode_utf7, encode as encode_utf7
+
+from tabellarius.capabilities import Capabilities, Feature
+from tabellarius.imap import IMAP
+from tabellarius.mail import Mail
+from tabellarius.misc import Helper
+
+
+class AsyncIMAP():
+    """
+    asyncio based IMAP server communication using aioimaplib, offering the same methods and return values as IMAP (as coroutines)
+
+    This allows to handle a lot of accounts within a single thread. STARTTLS is not supported by aioimaplib, use imaps instead.
+    """
+    Retval = IMAP.Retval
+
+    EXPUNGE_POLICIES = IMAP.EXPUNGE_POLICIES
+
+    SELECT_RESPONSE_RE = regex_compile(r'^(?:(?P<count>\d+) (?P<count_key>EXISTS|RECENT)|.*\[(?P<code_key>UIDVALIDITY|UIDNEXT|HIGHESTMODSEQ) '
+                                       r'(?P<code_value>\d+)\])')
+    LIST_RESPONSE_RE = regex_compile(r'^(?:LIST )?\((?P<flags>[^)]*)\) (?P<delimiter>NIL|"(?:[^"\\]|\\.)*") (?P<name>.*)$')
+    FETCH_LINE_RE = regex_compile(rb'^\d+ FETCH \(')
+    FETCH_UID_RE = regex_compile(rb'UID (\d+)')
+    FETCH_SIZE_RE = regex_compile(rb'RFC822\.SIZE (\d+)')
+    COPYUID_RE = regex_compile(r'\[COPYUID \d+ ([0-9:,]+) ([0-9:,]+)\]')
+
+    def __init__(self, logger, username, password,
+                 server='localhost',
+                 port=143,
+                 starttls=False,
+                 imaps=False,
+                 tlsverify=True,
+                 test=False,
+                 timeout=None,
+                 fetch_chunk_size=500,
+                 mailbox_cache_ttl=300,
+                 expunge_policy='immediate',
+                 max_mails_in_flight=None,
+                 max_bytes_in_flight=None):
+        self.logger = logger
+        self.username = username
+        self.password = password
+        self.server = server
+        self.port = port
+        self.imaps = imaps
+        self.starttls = starttls
+        self.timeout = timeout or aioimaplib.IMAP4.TIMEOUT_SECONDS
+
+        self.sslcontext = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        if not tlsverify:
+            self.sslcontext.check_hostname = False
+            self.sslcontext.verify_mode = ssl.CERT_NONE
+
+        self.test = test
+        self.fetch_chunk_size = fetch_chunk_size
+        self.conn = None
+
+        self.max_mails_in_flight = max_mails_in_flight
+        self.max_bytes_in_flight = max_bytes_in_flight
+
+        if expunge_policy not in self.EXPUNGE_POLICIES:
+            raise ValueError('Unsupported expunge policy {}'.format(expunge_policy))
+        self.expunge_policy = expunge_policy
+        self.pending_expunges = {}
+        self.uidvalidity = {}
+
+        self.mailbox_cache = None
+        self.mailbox_cache_time = 0
+        self.mailbox_cache_ttl = mailbox_cache_ttl
+
+        self.selected_mailbox = None
+        self.selected_readonly = False
+        self.selected_state = None
+
+        self.capabilities = Capabilities()
+
+    def do_select_mailbox(func):
+        """
+        Decorator to do a fresh mailbox SELECT before running the coroutine
+        """
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            await self.__select_mailbox_from_kwargs(kwargs, readonly=False)
+            return await func(self, *args, **kwargs)
+        return wrapper
+
+    def do_examine_mailbox(func):
+        """
+        Decorator to EXAMINE (read-only SELECT) a mailbox before running the coroutine
+        """
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            await self.__select_mailbox_from_kwargs(kwargs, readonly=True)
+            return await func(self, *args, **kwargs)
+        return wrapper
+
+    async def __select_mailbox_from_kwargs(self, kwargs, readonly):
+        """
+        Select the mailbox named by the mailbox (or source) keyword argument
+        """
+        mailbox = kwargs.get('source', kwargs.get('mailbox'))
+        if mailbox is None:
+            raise KeyError('Unable to SELECT a mailbox, kwargs "{0}" doesn\'t contain a mailbox name'.format(kwargs))
+
+        result = await self.select_mailbox(mailbox, readonly=readonly)
+        if not result.code:
+            raise RuntimeError(result.data)
+        return result
+
+    def process_error(self, exception):
+        """
+        Process Python exception by logging a message
+        """
+        err_msg = str(exception) or type(exception).__name__
+        self.logger.error('Catching IMAP exception {}: {}'.format(type(exception), err_msg))
+
+        if '[TRYCREATE]' in err_msg or '[NONEXISTENT]' in err_msg:
+            self.mailbox_cache = None
+        return self.Retval(False, err_msg)
+
+    def __check(self, response, command):
+        """
+        Raise an error if a command didn't complete successfully
+        """
+        if response.result != 'OK':
+            raise aioimaplib.Error('{} failed: {}'.format(command, self.__response_text(response)))
+        return response
+
+    def __response_text(self, response):
+        """
+        Return the text of a tagged response
+        """
+        if not response.lines:
+            return ''
+        return Helper().byte_to_str(bytes(response.lines[-1]))
+
+    def __quote_mailbox(self, mailbox):
+        """
+        Encode (modified UTF-7) and quote a mailbox name to be used as command argument
+        """
+        return aioimaplib.quoted(Helper().byte_to_str(encode_utf7(mailbox)))
+
+    async def connect(self):
+        """
+        Connect to IMAP server and login
+        """
+        if self.starttls:
+            return self.Retval(False, 'STARTTLS is not supported by the asyncio backend, please use imaps')
+
+        self.logger.debug('Establishing IMAP connection to {}:{} and logging in with user {}'.format(self.server, self.port, self.username))
+        self.selected_mailbox = None
+        try:
+            if self.imaps:
+                self.conn = aioimaplib.IMAP4_SSL(host=self.server, port=self.port, timeout=self.timeout, ssl_context=self.sslcontext)
+            else:
+                self.conn = aioimaplib.IMAP4(host=self.server, port=self.port, timeout=self.timeout)
+            await self.conn.wait_hello_from_server()
+
+            response = await self.conn.login(self.username, self.password)
+            if response.result != 'OK':
+                return self.Retval(False, self.__response_text(response))
+
+            # The capabilities announced before LOGIN may be incomplete
+            await self.conn.protocol.capability()
+            self.capabilities = Capabilities(self.conn.protocol.capabilities)
+            self.logger.debug('Server capabilities: {}'.format(' '.join(sorted(self.capabilities.raw))))
+
+            await self.refresh_mailbox_cache()
+            return self.Retval(True, self.__response_text(response))
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    async def disconnect(self):
+        """
+        Disconnect from IMAP server
+        """
+        self.selected_mailbox = None
+        try:
+            response = await self.conn.logout()
+            return self.Retval(response.result == 'OK', self.__response_text(response))
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+        finally:
+            # Close the socket even if the server didn't answer the LOGOUT
+            if self.conn.protocol.transport is not None:
+                self.conn.protocol.transport.close()
+
+    async def noop(self):
+        """
+        Do a noop to test the connection
+        """
+        try:
+            response = await self.conn.noop()
+            return self.Retval(response.result == 'OK', self.__response_text(response))
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    def has_capability(self, capability):
+        """
+        Check whether the server supports a capability (a Feature or its name), using the capabilities cached at login
+        """
+        return capability in self.capabilities
+
+    async def select_mailbox(self, mailbox, readonly=False, force=False):
+        """
+        Select a mailbox to work on, readonly uses EXAMINE
+
+        The mailbox isn't selected again if it's selected already (in a sufficient mode), unless force is set.
+        """
+        if self.test:
+            readonly = True
+
+        if not force and mailbox == self.selected_mailbox and (readonly or not self.selected_readonly):
+            return self.Retval(True, self.selected_state)
+
+        self.logger.debug('Switching to mailbox {} ({})'.format(mailbox, 'EXAMINE' if readonly else 'SELECT'))
+        self.selected_mailbox = None
+        try:
+            if readonly:
+                response = await self.conn.examine(self.__quote_mailbox(mailbox))
+            else:
+                response = await self.conn.select(self.__quote_mailbox(mailbox))
+            self.__check(response, 'SELECT')
+
+            # aioimaplib only tracks SELECT, but commands like UID FETCH are allowed after EXAMINE as well
+            self.conn.protocol.state = aioimaplib.SELECTED
+
+            state = {}
+            for line in response.lines:
+                line = Helper().byte_to_str(bytes(line))
+                match = self.SELECT_RESPONSE_RE.match(line)
+                if match and match.group('count'):
+                    state[match.group('count_key')] = int(match.group('count'))
+                elif match and match.group('code_value'):
+                    state[match.group('code_key')] = int(match.group('code_value'))
+
+            # UIDs are meaningless once UIDVALIDITY changes
+            if mailbox in self.uidvalidity and self.uidvalidity[mailbox] != state.get('UIDVALIDITY'):
+                self.pending_expunges.pop(mailbox, None)
+            self.uidvalidity[mailbox] = state.get('UIDVALIDITY')
+
+            self.selected_mailbox = mailbox
+            self.selected_readonly = readonly
+            self.selected_state = state
+            return self.Retval(True, state)
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    @do_examine_mailbox
+    async def search_mails(self, mailbox, criteria='ALL', min_uid=None):
+        """
+        Search for mails in a mailbox, optionally only for those having a UID of at least min_uid
+        """
+        if min_uid is not None:
+            criteria = 'UID {}:* {}'.format(min_uid, criteria)
+
+        self.logger.debug('Searching for mails in mailbox {} and criteria=\'{}\''.format(mailbox, criteria))
+        try:
+            response = self.__check(await self.conn.uid_search(criteria, charset=None), 'SEARCH')
+            uids = []
+            for line in response.lines[:-1]:
+                uids.extend(int(uid) for uid in Helper().byte_to_str(bytes(line)).split() if uid.isdigit())
+            if min_uid is not None:
+                # "n:*" always includes the highest UID of the mailbox, even if it's lower than n
+                uids = [uid for uid in uids if uid >= min_uid]
+            return self.Retval(True, uids)
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    @do_examine_mailbox
+    async def fetch_mails(self, uids, mailbox, headers=None):
+        """
+        Retrieve mails from a mailbox
+
+        If a list of header names is given, only these headers (plus Message-Id) are fetched instead of the whole mail
+        """
+        self.logger.debug('Fetching mails with uids {}'.format(uids))
+
+        if headers is None:
+            fields = '(RFC822)'
+        else:
+            header_names = sorted(set([header.upper() for header in headers] + ['MESSAGE-ID']))
+            fields = '(BODY.PEEK[HEADER.FIELDS ({})])'.format(' '.join(header_names))
+
+        mails = {}
+        try:
+            for chunk in Helper().chunks(uids, self.fetch_chunk_size):
+                response = self.__check(await self.conn.uid('fetch', Helper().uids_to_sequence_set(chunk), fields), 'FETCH')
+
+                # The UID may be sent before or after the literal, so keep the literal until the FETCH response is complete
+                fetches = []
+                for line in response.lines[:-1]:
+                    if isinstance(line, bytearray):
+                        if fetches:
+                            fetches[-1][1] = line
+                        continue
+
+                    if self.FETCH_LINE_RE.match(line):
+                        fetches.append([None, None])
+                    match = self.FETCH_UID_RE.search(line)
+                    if match and fetches and fetches[-1][0] is None:
+                        fetches[-1][0] = int(match.group(1))
+
+                for uid, literal in fetches:
+                    if uid is not None and literal is not None:
+                        mails[uid] = Mail(logger=self.logger, mail_native=email.message_from_bytes(bytes(literal)), uid=uid)
+            return self.Retval(True, dict((uid, mails[uid]) for uid in uids if uid in mails))
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    async def stream_mails(self, uids, mailbox, headers=None):
+        """
+        Retrieve mails batch by batch instead of all at once, yielding Retval(True, {uid: Mail}) per batch (see IMAP.stream_mails)
+        """
+        sizes = None
+        if self.max_bytes_in_flight and headers is None:
+            result = await self.get_mail_sizes(uids=uids, mailbox=mailbox)
+            if not result.code:
+                yield result
+                return
+            sizes = result.data
+
+        for batch in Helper().batches(uids, max_items=self.max_mails_in_flight, sizes=sizes, max_size=self.max_bytes_in_flight):
+            result = await self.fetch_mails(uids=batch, mailbox=mailbox, headers=headers)
+            yield result
+            if not result.code:
+                return
+
+    @do_examine_mailbox
+    async def get_mail_sizes(self, uids, mailbox):
+        """
+        Retrieve the sizes (RFC822.SIZE) of mails
+        """
+        try:
+            sizes = {}
+            for chunk in Helper().chunks(uids, self.fetch_chunk_size):
+                response = self.__check(await self.conn.uid('fetch', Helper().uids_to_sequence_set(chunk), '(RFC822.SIZE)'), 'FETCH')
+                for line in response.lines[:-1]:
+                    uid, size = self.FETCH_UID_RE.search(line), self.FETCH_SIZE_RE.search(line)
+                    if uid and size:
+                        sizes[int(uid.group(1))] = int(size.group(1))
+            return self.Retval(True, sizes)
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    async def __store(self, uids, mailbox, command, flags):
+        """
+        Change flags of mails without retrieving them
+        """
+        if self.test:
+            self.logger.info('Would have changed mail flags ({} {}) on message uids "{}"'.format(command, flags, uids))
+            return self.Retval(True, None)
+
+        self.logger.debug('Changing flags ({} {}) on mails uid={}'.format(command, flags, uids))
+        try:
+            self.__check(await self.conn.uid('store', Helper().uids_to_sequence_set(uids), command, '({})'.format(' '.join(flags))), 'STORE')
+            return self.Retval(True, None)
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    @do_select_mailbox
+    async def set_mailflags(self, uids, mailbox, flags=[]):
+        """
+        Set flags of mails
+        """
+        return await self.__store(uids=uids, mailbox=mailbox, command='FLAGS.SILENT', flags=flags)
+
+    @do_select_mailbox
+    async def set_mailflags_many(self, mailbox, flag_sets):
+        """
+        Set flags on several sets of mails ({flags: uids})
+        """
+        for flags, uids in flag_sets.items():
+            if not uids:
+                continue
+            result = await self.__store(uids=uids, mailbox=mailbox, command='FLAGS.SILENT', flags=flags)
+            if not result.code:
+                return result
+        return self.Retval(True, None)
+
+    @do_select_mailbox
+    async def add_mailflags(self, uids, mailbox, flags=[]):
+        """
+        Add flags to mails
+        """
+        return await self.__store(uids=uids, mailbox=mailbox, command='+FLAGS.SILENT', flags=flags)
+
+    async def move_mail(self, source, destination, message_ids=None, uids=None, delete_old=True, expunge=True, add_flags=None, set_flags=None):
+        """
+        Move mails from a mailbox to another
+        """
+        return await self.copy_mails(source=source,
+                                     destination=destination,
+                                     message_ids=message_ids,
+                                     uids=uids,
+                                     delete_old=delete_old,
+                                     expunge=expunge,
+                                     add_flags=add_flags,
+                                     set_flags=set_flags)
+
+    @do_select_mailbox
+    async def copy_mails(self, source, destination, message_ids=None, uids=None, delete_old=False, expunge=False, add_flags=None, set_flags=None):
+        """
+        Copies one or more mails (by Message-Id or UID) from a mailbox into another
+        """
+        if self.test:
+            self.logger.info('Would have {} mails with Message-Ids="{}"/uids="{}" from "{}" to "{}", skipping because of beeing in testmode'.format(
+                'moved' if delete_old else 'copied', message_ids, uids, source, destination))
+            return self.Retval(True, None)
+
+        self.logger.debug('{} mails Message-Ids="{}"/uids="{}" from "{}" to "{}"'.format(
+            'Moving' if delete_old else 'Copying', message_ids, uids, source, destination))
+        try:
+            if not (await self.mailbox_exists(destination)).data:
+                self.logger.info('Destination mailbox {} doesn\'t exist, creating it for you'.format(destination))
+                result = await self.create_mailbox(mailbox=destination)
+                if not result.code:
+                    return result
+
+            if uids is None:
+                uids = []
+                for message_id in message_ids:
+                    result = await self.search_mails(mailbox=source, criteria='HEADER Message-Id "{}"'.format(message_id))
+                    if not result.code or not result.data:
+                        self.logger.error('Failed to determine uid by Message-Id for mail with Message-Id "{}"'.format(message_id))
+                        return self.Retval(False, result.data)
+                    uids.append(result.data[0])
+            elif (isinstance(set_flags, list) or add_flags) and not self.has_capability(Feature.UIDPLUS):
+                # The Message-Ids are needed to find the copied mails, as the server doesn't send COPYUID
+                result = await self.fetch_mails(uids=uids, mailbox=source, headers=[])
+                if not result.code:
+                    return result
+                message_ids = [result.data[uid].get_message_id() for uid in uids if uid in result.data]
+
+            result = await self.select_mailbox(source)
+            if not result.code:
+                return result
+
+            uid_set = Helper().uids_to_sequence_set(uids)
+            if delete_old and self.has_capability(Feature.MOVE):
+                response = self.__check(await self.conn.uid('move', uid_set, self.__quote_mailbox(destination)), 'MOVE')
+            else:
+                response = self.__check(await self.conn.uid('copy', uid_set, self.__quote_mailbox(destination)), 'COPY')
+                if delete_old:
+                    self.__check(await self.conn.uid('store', uid_set, '+FLAGS.SILENT', '(\\Deleted)'), 'STORE')
+                    if expunge and self.expunge_policy == 'end_of_cycle':
+                        self.pending_expunges.setdefault(source, []).extend(uids)
+                    elif expunge:
+                        result = await self.__expunge_moved(mailbox=source, uids=uids)
+                        if not result.code:
+                            return result
+
+            dest_uids = None
+            for line in response.lines:
+                match = self.COPYUID_RE.search(Helper().byte_to_str(bytes(line)))
+                if match:
+                    uid_map = dict(zip(Helper().sequence_set_to_uids(match.group(1)), Helper().sequence_set_to_uids(match.group(2))))
+                    dest_uids = [uid_map[uid] for uid in uids if uid in uid_map]
+            if dest_uids is None and message_ids:
+                # Search for the new UIDs if the server doesn't support UIDPLUS
+                dest_uids = []
+                for message_id in message_ids:
+                    result = await self.search_mails(mailbox=destination, criteria='HEADER Message-Id "{}"'.format(message_id))
+                    if not result.code or not result.data:
+                        self.logger.error('Failed to determine uid in {} by Message-Id for mail with Message-Id "{}"'.format(destination, message_id))
+                        return self.Retval(False, result.data)
+                    dest_uids.append(result.data[0])
+            elif dest_uids is None:
+                self.logger.debug('Server didn\'t send COPYUID, UIDs of the mails in {} are unknown'.format(destination))
+                return self.Retval(True, None)
+
+            if isinstance(set_flags, list):
+                await self.set_mailflags(uids=dest_uids, mailbox=destination, flags=set_flags)
+            if add_flags:
+                await self.add_mailflags(uids=dest_uids, mailbox=destination, flags=add_flags)
+            return self.Retval(True, dest_uids)
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    async def __expunge_moved(self, mailbox, uids):
+        """
+        Expunge mails that were copied to another mailbox and flagged as deleted
+        """
+        if self.has_capability(Feature.UIDPLUS):
+            return await self.expunge(mailbox=mailbox, uids=uids)
+        elif self.expunge_policy == 'uid_only':
+            self.logger.debug('Server doesn\'t support UID EXPUNGE, leaving mails with uids {} in mailbox {}'.format(uids, mailbox))
+            return self.Retval(True, False)
+        return await self.expunge(mailbox=mailbox)
+
+    async def flush_expunges(self):
+        """
+        Expunge all mails collected by the end_of_cycle expunge policy, with one EXPUNGE per mailbox
+        """
+        expunged = {}
+        while self.pending_expunges:
+            mailbox, uids = self.pending_expunges.popitem()
+            result = await self.__expunge_moved(mailbox=mailbox, uids=uids)
+            if not result.code:
+                return result
+            expunged[mailbox] = uids
+        return self.Retval(True, expunged)
+
+    @do_select_mailbox
+    async def expunge(self, mailbox, uids=None):
+        """
+        Expunge mails form a mailbox, optionally only those with the given UIDs (requires UIDPLUS)
+        """
+        self.logger.debug('Expunge mails from mailbox {}'.format(mailbox))
+        try:
+            if uids:
+                self.__check(await self.conn.uid('expunge', Helper().uids_to_sequence_set(uids)), 'EXPUNGE')
+            else:
+                self.__check(await self.conn.expunge(), 'EXPUNGE')
+            return self.Retval(True, True)
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    async def create_mailbox(self, mailbox):
+        """
+        Create a mailbox
+        """
+        self.logger.debug('Creating mailbox {}'.format(mailbox))
+        try:
+            response = await self.conn.create(self.__quote_mailbox(mailbox))
+            if response.result != 'OK' and '[ALREADYEXISTS]' in self.__response_text(response):
+                # Another client created the mailbox after the cache was refreshed (RFC 5530)
+                self.logger.debug('Mailbox {} exists already, refreshing the mailbox cache'.format(mailbox))
+                await self.refresh_mailbox_cache()
+                return self.Retval(True, False)
+
+            self.__check(response, 'CREATE')
+            if self.mailbox_cache is not None:
+                self.mailbox_cache.add(mailbox)
+            return self.Retval(True, True)
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
+
+    async def refresh_mailbox_cache(self):
+        """
+        Fetch the names of all mailboxes with a single LIST command
+        """
+        try:
+            response = self.__check(await self.conn.list('""', '*'), 'LIST')
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            self.mailbox_cache = None
+            return self.process_error(e)
+
+        self.mailbox_cache = set()
+        for line in response.lines[:-1]:
+            match = self.LIST_RESPONSE_RE.match(Helper().byte_to_str(bytes(line)))
+            if match:
+                name = match.group('name')
+                if name.startswith('"'):
+                    name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                self.mailbox_cache.add(decode_utf7(name.encode('ascii')))
+        self.mailbox_cache_time = asyncio.get_running_loop().time()
+        return self.Retval(True, self.mailbox_cache)
+
+    async def mailbox_exists(self, mailbox):
+        """
+        Check whether a mailbox exists
+        """
+        if self.mailbox_cache is None or asyncio.get_running_loop().time() - self.mailbox_cache_time >= self.mailbox_cache_ttl:
+            result = await self.refresh_mailbox_cache()
+            if not result.code:
+                return result
+
+        if mailbox.upper() == 'INBOX':
+            mailbox = 'INBOX'
+        return self.Retval(True, mailbox in self.mailbox_cache)
+
+    async def idle(self, mailbox, timeout):
+        """
+        Wait (IDLE, RFC 2177) until the server reports changes of a mailbox or timeout seconds have passed
+
+        Returns whether new mails (EXISTS/RECENT) arrived.
+        """
+        result = await self.select_mailbox(mailbox)
+        if not result.code:
+            return result
+
+        try:
+            idle = await self.conn.idle_start(timeout=timeout)
+            responses = await self.conn.wait_server_push(timeout=timeout + self.timeout)
+            self.conn.idle_done()
+            await asyncio.wait_for(idle, self.timeout)
+
+            if responses == aioimaplib.STOP_WAIT_SERVER_PUSH:
+                return self.Retval(True, False)
+            return self.Retval(True, any(response.endswith((b'EXISTS', b'RECENT')) for response in responses))
+        except (aioimaplib.AioImapException, asyncio.TimeoutError, OSError) as e:
+            return self.process_error(e)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from enum import Enum
+
+from tabellarius.misc import Helper
+
+
+class Feature(Enum):
+    """
+    IMAP extensions that are relevant for tabellarius, the value is the capability announced by the server
+    """
+    MOVE = 'MOVE'                       # RFC 6851
+    UIDPLUS = 'UIDPLUS'                 # RFC 4315
+    CONDSTORE = 'CONDSTORE'             # RFC 7162
+    QRESYNC = 'QRESYNC'                 # RFC 7162
+    ENABLE = 'ENABLE'                   # RFC 5161
+    IDLE = 'IDLE'                       # RFC 2177
+    ESEARCH = 'ESEARCH'                 # RFC 4731
+    COMPRESS = 'COMPRESS=DEFLATE'       # RFC 4978
+    LITERAL_PLUS = 'LITERAL+'           # RFC 7888
+    LIST_STATUS = 'LIST-STATUS'         # RFC 5819
+    NOTIFY = 'NOTIFY'                   # RFC 5465
+
+
+class Capabilities():
+    """
+    Capabilities of an IMAP server, as announced once per connection (after STARTTLS/LOGIN)
+    """
+
+    def __init__(self, capabilities=()):
+        self.raw = frozenset(Helper().byte_to_str(capability).upper() for capability in capabilities)
+
+        features = set(feature for feature in Feature if feature.value in self.raw)
+        # QRESYNC implies CONDSTORE (RFC 7162, 3.2.3)
+        if Feature.QRESYNC in features:
+            features.add(Feature.CONDSTORE)
+        self.features = frozenset(features)
+
+    def __contains__(self, capability):
+        """
+        Check for a Feature or any other capability given by name
+        """
+        if isinstance(capability, Feature):
+            return capability in self.features
+        return Helper().byte_to_str(capability).upper() in self.raw
+
+    def __str__(self):
+        return ', '.join(sorted(feature.name for feature in self.features)) or 'none'
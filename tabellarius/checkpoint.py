@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+import json
+import os
+import threading
+
+
+class Checkpoint():
+    """
+    Persistent store of the highest processed UID per account and mailbox
+    """
+
+    def __init__(self, logger, path=None, readonly=False):
+        self.logger = logger
+        self.path = path
+        # Read-only checkpoints (e.g. in test mode) are kept in memory, a dry run must not skip mails of the next real run
+        self.readonly = readonly
+        self.state = {}
+        self.dirty = False
+        # Accounts may be processed by several threads at once
+        self.lock = threading.RLock()
+
+        if self.path:
+            self.path = os.path.expanduser(self.path)
+
+    def load(self):
+        """
+        Load checkpoints from disk
+        """
+        if not self.path or not os.path.exists(self.path):
+            return self.state
+
+        try:
+            with open(self.path, 'r') as stream:
+                self.state = json.load(stream)
+        except (OSError, ValueError) as e:
+            self.logger.error('Failed to load checkpoints from {}, starting from scratch: {}'.format(self.path, e))
+            self.state = {}
+        return self.state
+
+    def save(self):
+        """
+        Write checkpoints to disk (atomically) if they changed
+        """
+        with self.lock:
+            if not self.path or not self.dirty or self.readonly:
+                return False
+
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as stream:
+                json.dump(self.state, stream)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        return True
+
+    def get(self, account, mailbox, uidvalidity):
+        """
+        Return the highest processed UID of a mailbox or 0 if there is no valid checkpoint
+        """
+        with self.lock:
+            checkpoint = self.state.get(account, {}).get(mailbox)
+            if checkpoint is None:
+                return 0
+
+            if checkpoint.get('uidvalidity') != uidvalidity:
+                self.logger.info('{}: UIDVALIDITY of mailbox {} changed from {} to {}, dropping checkpoint'.format(
+                    account, mailbox, checkpoint.get('uidvalidity'), uidvalidity))
+                del self.state[account][mailbox]
+                self.dirty = True
+                return 0
+
+            return checkpoint.get('last_uid', 0)
+
+    def get_highestmodseq(self, account, mailbox):
+        """
+        Return the HIGHESTMODSEQ (RFC 7162) a mailbox had when it was processed the last time
+        """
+        return self.state.get(account, {}).get(mailbox, {}).get('highestmodseq')
+
+    def get_uidnext(self, account, mailbox):
+        """
+        Return the UIDNEXT a mailbox had when it was processed the last time, it grows as soon as another mail arrives
+        """
+        return self.state.get(account, {}).get(mailbox, {}).get('uidnext')
+
+    def set(self, account, mailbox, uidvalidity, last_uid, highestmodseq=None, uidnext=None):
+        """
+        Record the highest processed UID (and optionally the HIGHESTMODSEQ and UIDNEXT) of a mailbox
+        """
+        checkpoint = {'uidvalidity': uidvalidity, 'last_uid': last_uid, 'highestmodseq': highestmodseq, 'uidnext': uidnext}
+        with self.lock:
+            if self.state.get(account, {}).get(mailbox) != checkpoint:
+                self.state.setdefault(account, {})[mailbox] = checkpoint
+                self.dirty = True
+            return self.state[account][mailbox]
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+import asyncio
+from logging import DEBUG as loglevel_DEBUG
+from random import uniform
+from sys import exc_info
+from time import time
+from traceback import print_exception
+
+from tabellarius.imap import IMAP
+
+
+class ConnectionManager():
+    """
+    Keeps the IMAP connection of an account usable: detects dead connections, reconnects with exponential backoff (and jitter),
+    restores the selected mailbox and sends keepalives
+
+    Failures are contained per account, an account waiting for its next reconnect attempt is simply skipped.
+    """
+
+    def __init__(self, logger, imap, backoff=2, backoff_max=300, keepalive_interval=300):
+        self.logger = logger
+        self.imap = imap
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.keepalive_interval = keepalive_interval
+
+        self.connected = False
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_activity = 0
+
+    def get_backoff(self):
+        """
+        Return the time to wait before the next reconnect attempt: exponentially growing with the number of failures, half of it randomized
+        """
+        delay = min(self.backoff * 2 ** max(self.failures - 1, 0), self.backoff_max)
+        return delay / 2 + uniform(0, delay / 2)
+
+    def record_failure(self, error):
+        """
+        Mark the connection as broken and schedule the next reconnect attempt
+        """
+        self.connected = False
+        self.failures += 1
+        delay = self.get_backoff()
+        self.next_attempt = time() + delay
+        self.logger.error('Connection failed ({} failure(s) in a row), trying again in {:.1f} seconds: {}'.format(self.failures, delay, error))
+
+    def record_success(self):
+        """
+        Mark the connection as working
+        """
+        if self.failures:
+            self.logger.info('Connection recovered after {} failure(s)'.format(self.failures))
+        self.connected = True
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_activity = time()
+
+    def waiting(self):
+        """
+        Whether the account waits for its next reconnect attempt
+        """
+        return not self.connected and time() < self.next_attempt
+
+    def keepalive_due(self):
+        """
+        Whether the connection wasn't used for keepalive_interval seconds
+        """
+        return self.connected and self.keepalive_interval and time() - self.last_activity >= self.keepalive_interval
+
+    def next_keepalive(self):
+        """
+        Return when the next keepalive is due or None if there is no connection to keep alive
+        """
+        if not self.connected or not self.keepalive_interval:
+            return None
+        return self.last_activity + self.keepalive_interval
+
+    def get_idle_timeout(self, idle_timeout):
+        """
+        Return after how many seconds IDLE needs to be re-issued, so that the connection is used at least every keepalive_interval seconds
+        """
+        if not self.keepalive_interval:
+            return idle_timeout
+        return min(idle_timeout, self.keepalive_interval)
+
+    def connect(self):
+        """
+        (Re)connect and restore the previously selected mailbox
+        """
+        mailbox, readonly = self.imap.selected_mailbox, self.imap.selected_readonly
+
+        # Log out the old connection and the fetch pool, so neither sockets nor server sessions are leaked
+        if self.imap.conn is not None:
+            self.imap.disconnect()
+
+        result = self.imap.connect(retry=False)
+        if result.code and mailbox is not None:
+            result = self.imap.select_mailbox(mailbox, readonly=readonly)
+
+        if not result.code:
+            self.record_failure(result.data)
+        else:
+            self.logger.info('Connected to {}, supported features: {}'.format(self.imap.server, self.imap.capabilities))
+            self.record_success()
+        return result
+
+    def ensure_connected(self):
+        """
+        Return whether the connection is usable, checking idle connections with NOOP and reconnecting if necessary
+        """
+        if self.waiting():
+            return False
+
+        if self.connected and self.keepalive_due():
+            self.keepalive()
+
+        if not self.connected:
+            self.logger.info('Connecting to {}'.format(self.imap.server))
+            return self.connect().code
+        return True
+
+    def keepalive(self):
+        """
+        Send a NOOP if the connection wasn't used for a while, so that neither the server nor NAT devices drop it
+        """
+        if not self.keepalive_due():
+            return IMAP.Retval(True, None)
+
+        self.logger.debug('Sending keepalive')
+        result = self.imap.noop()
+        if result.code:
+            self.last_activity = time()
+        else:
+            self.record_failure('Keepalive failed: {}'.format(result.data))
+        return result
+
+    def run(self, func, **kwargs):
+        """
+        Run func(imap=..., **kwargs) on the managed connection, turning every exception into a failure of this account only
+
+        The connection is only considered broken (and reconnected) if a NOOP fails afterwards.
+        """
+        if not self.ensure_connected():
+            return IMAP.Retval(False, 'Not connected, next attempt in {:.1f} seconds'.format(max(self.next_attempt - time(), 0)))
+
+        try:
+            result = func(imap=self.imap, **kwargs)
+        except Exception as e:
+            self.__log_exception(e)
+            # Only reconnect if the connection is broken, not because of e.g. a mail that couldn't be processed
+            if not self.imap.noop().code:
+                self.record_failure(e)
+            return IMAP.Retval(False, str(e))
+
+        # Tell broken connections apart from other failures (e.g. a missing mailbox)
+        if not result.code and not self.imap.noop().code:
+            self.record_failure(result.data)
+        else:
+            self.last_activity = time()
+        return result
+
+    async def keepalive_async(self):
+        """
+        Send a NOOP if the connection wasn't used for a while using the asyncio backend (see keepalive)
+        """
+        if not self.keepalive_due():
+            return IMAP.Retval(True, None)
+
+        self.logger.debug('Sending keepalive')
+        result = await self.imap.noop()
+        if result.code:
+            self.last_activity = time()
+        else:
+            self.record_failure('Keepalive failed: {}'.format(result.data))
+        return result
+
+    async def sleep_async(self, seconds):
+        """
+        Sleep for the given number of seconds, sending keepalives in the meantime
+        """
+        deadline = time() + seconds
+        while True:
+            await self.keepalive_async()
+            now = time()
+            if now >= deadline:
+                return
+            wakeup = min(deadline, self.next_keepalive() or deadline)
+            await asyncio.sleep(max(wakeup - now, 0))
+
+    async def connect_async(self):
+        """
+        (Re)connect and restore the previously selected mailbox using the asyncio backend
+        """
+        mailbox, readonly = self.imap.selected_mailbox, self.imap.selected_readonly
+
+        if self.imap.conn is not None:
+            await self.imap.disconnect()
+
+        result = await self.imap.connect()
+        if result.code and mailbox is not None:
+            result = await self.imap.select_mailbox(mailbox, readonly=readonly)
+
+        if not result.code:
+            self.record_failure(result.data)
+        else:
+            self.logger.info('Connected to {}, supported features: {}'.format(self.imap.server, self.imap.capabilities))
+            self.record_success()
+        return result
+
+    async def run_async(self, func, **kwargs):
+        """
+        Run the coroutine func(imap=..., **kwargs) on the managed connection, turning every exception into a failure of this account only
+        """
+        if self.waiting():
+            return IMAP.Retval(False, 'Not connected, next attempt in {:.1f} seconds'.format(self.next_attempt - time()))
+
+        if self.connected and self.keepalive_due():
+            await self.keepalive_async()
+
+        if not self.connected:
+            self.logger.info('Connecting to {}'.format(self.imap.server))
+            result = await self.connect_async()
+            if not result.code:
+                return result
+
+        try:
+            result = await func(imap=self.imap, **kwargs)
+        except Exception as e:
+            self.__log_exception(e)
+            if not (await self.imap.noop()).code:
+                self.record_failure(e)
+            return IMAP.Retval(False, str(e))
+
+        if not result.code and not (await self.imap.noop()).code:
+            self.record_failure(result.data)
+        else:
+            self.last_activity = time()
+        return result
+
+    def __log_exception(self, exception):
+        """
+        Log an unexpected exception, with stack trace in debug mode
+        """
+        trace_info = exc_info()
+        self.logger.error('Catching exception while working on the account: {}'.format(exception))
+        if self.logger.isEnabledFor(loglevel_DEBUG):
+            print_exception(*trace_info)
+        del trace_info
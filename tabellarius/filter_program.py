@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict, deque
+from re import compile as regex_compile, error as regex_error
+
+from tabellarius.misc import Helper
+
+
+class AhoCorasick():
+    """
+    Aho-Corasick automaton, finds all occurrences of many strings within a text in a single pass
+    """
+
+    def __init__(self, words):
+        """
+        words maps the strings to search for to the keys to return for them
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for word, key in words.items():
+            state = 0
+            for char in word:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state].append(key)
+
+        # Breadth-first, so the failure state of each state is complete before it's used
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail if fail != next_state else 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """
+        Return the keys of all strings found in text
+        """
+        found = set(self.output[0]) if text else set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found.update(self.output[state])
+        return found
+
+
+class HeaderMatcher():
+    """
+    Matches a header value against all patterns of all filters at once: the literal parts by one Aho-Corasick automaton, the
+    regular expressions by one combined expression
+
+    The combined expression is a sequence of optional lookaheads, one per pattern, so that every pattern matching at the start
+    of the value sets its named group (an alternation would stop at the first one). Patterns that can't be combined
+    (backreferences, conditionals, inline flags) are matched one by one. Invalid ones are left to CompiledRule.match.
+    """
+
+    REGEX_CHARS = frozenset('.^$*+?{}[]\\|()')
+    UNCOMBINABLE_RE = regex_compile(r'\\[0-9]|\(\?\(|\(\?[aimsux-]+[:)]')
+
+    def __init__(self, patterns):
+        """
+        patterns maps ids to the CompiledPatterns of a header
+        """
+        self.automaton = AhoCorasick(dict((pattern.pattern, pattern_id) for pattern_id, pattern in patterns.items()))
+
+        self.fallback = []
+        combined = []
+        for pattern_id, pattern in sorted(patterns.items()):
+            # Without regex operators, a regex match implies a substring match
+            if not self.REGEX_CHARS.intersection(pattern.pattern):
+                continue
+            if pattern.regex is None:
+                continue
+            elif self.UNCOMBINABLE_RE.search(pattern.pattern):
+                self.fallback.append((pattern, pattern_id))
+            else:
+                combined.append('(?:(?=(?P<p{}>{})))?'.format(pattern_id, pattern.pattern))
+        self.regex = regex_compile(''.join(combined)) if combined else None
+
+    def match(self, string):
+        """
+        Return the ids of all patterns matching a lowercased string (see CompiledPattern.match)
+        """
+        if not string:
+            return set()
+
+        found = self.automaton.search(string)
+        if self.regex is not None:
+            found.update(int(name[1:]) for name, value in self.regex.match(string).groupdict().items() if value is not None)
+        for pattern, pattern_id in self.fallback:
+            if pattern_id not in found and pattern.match(string):
+                found.add(pattern_id)
+        return found
+
+
+class CompiledPattern():
+    """
+    A lowercased pattern and its precompiled regular expression
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern.lower()
+        try:
+            self.regex = regex_compile(self.pattern)
+        except regex_error:
+            # Invalid regular expressions fail when they are needed, like they always did
+            self.regex = None
+
+    def match(self, string):
+        """
+        Test whether a lowercased string contains the pattern or matches it as regular expression (see MailFilter.check_match)
+        """
+        if not string:
+            return False
+
+        if self.pattern in string:
+            return True
+        return (self.regex or regex_compile(self.pattern)).match(string) is not None
+
+
+class CompiledRule():
+    """
+    A header name and the patterns its value is checked against
+    """
+
+    def __init__(self, rule):
+        self.header_name = next(iter(rule)).lower()
+        self.patterns = [CompiledPattern(pattern) for pattern in rule[next(iter(rule))]]
+
+        # Ids of the patterns within the HeaderMatcher of the header (see FilterProgram)
+        self.pattern_ids = frozenset()
+        # Invalid regular expressions have to fail exactly when they are reached
+        self.has_invalid_patterns = any(pattern.regex is None for pattern in self.patterns)
+
+    def match(self, mail):
+        """
+        Test whether any value of the header matches any pattern (see MailFilter.check_rule_match)
+        """
+        header_value = mail.get_header(self.header_name, None)
+        if header_value is None:
+            return False
+
+        values = [value.lower() for value in (header_value if isinstance(header_value, list) else [header_value]) if value]
+        return any(pattern.match(value) for pattern in self.patterns for value in values)
+
+
+class CompiledFilter():
+    """
+    A filter whose rows of and/or rule groups are ready to be evaluated
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.commands = config.get('commands')
+
+        # Rows of (is_and, rules, required header names), an 'and' group can't match if one of its headers is missing
+        self.rows = []
+        for row in config.get('rules'):
+            operators = []
+            for left, right in row.items():
+                if left not in ('and', 'or'):
+                    raise NotImplementedError('Sorry, operator \'{0}\' isn\'t supported yet!'.format(left))
+                rules = [CompiledRule(rule) for rule in right]
+                if left == 'and' and not any(rule.has_invalid_patterns for rule in rules):
+                    required_headers = frozenset(rule.header_name for rule in rules)
+                else:
+                    # Invalid regular expressions have to fail exactly when they are reached, so these rules are always evaluated
+                    required_headers = frozenset()
+                operators.append((left == 'and', rules, required_headers))
+            self.rows.append(operators)
+
+        self.header_names = frozenset(rule.header_name for operators in self.rows for _, rules, _ in operators for rule in rules)
+
+    def match(self, mail, rule_match=None, header_names=None):
+        """
+        Test whether the filter matches a mail (see MailFilter.check_rules_match), optionally using rule_match(rule) to evaluate
+        rules and skipping 'and' groups whose headers aren't all among the mail's header_names
+        """
+        if rule_match is None:
+            rule_match = lambda rule: rule.match(mail)
+
+        match = False
+        for operators in self.rows:
+            for is_and, rules, required_headers in operators:
+                if is_and:
+                    if header_names is not None and not required_headers <= header_names:
+                        match = False
+                    else:
+                        match = bool(rules) and all(rule_match(rule) for rule in rules)
+                else:
+                    match = any(rule_match(rule) for rule in rules)
+            if match:
+                break
+        return match
+
+
+class DecisionCache():
+    """
+    Bounded LRU cache of the first matching filter (or None) per fingerprint of the header values the filters look at
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.digest = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Accounts may be processed by several threads at once
+        self.lock = threading.Lock()
+
+    def get(self, digest, fingerprint):
+        """
+        Return (True, filter name or None) if a decision of the filters with the given digest is cached, (False, None) otherwise
+        """
+        with self.lock:
+            if digest != self.digest:
+                # The filters changed, all decisions are void
+                self.entries.clear()
+                self.digest = digest
+
+            if fingerprint in self.entries:
+                self.entries.move_to_end(fingerprint)
+                self.hits += 1
+                return True, self.entries[fingerprint]
+            self.misses += 1
+            return False, None
+
+    def set(self, digest, fingerprint, filter_name):
+        """
+        Remember a decision, evicting the least recently used ones beyond max_size
+        """
+        with self.lock:
+            if digest != self.digest:
+                self.entries.clear()
+                self.digest = digest
+
+            self.entries[fingerprint] = filter_name
+            self.entries.move_to_end(fingerprint)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class FilterProgram():
+    """
+    The filters of an account, compiled once and sorted in the order they are applied
+    """
+
+    def __init__(self, filters, cache=None):
+        self.filters = [CompiledFilter(name, config) for name, config in Helper().sort_dict(filters or {}).items()]
+        self.filters_by_name = dict((compiled.name, compiled) for compiled in self.filters)
+
+        # All patterns of a header, across all filters, are matched at once
+        patterns = {}
+        pattern_ids = {}
+        for compiled in self.filters:
+            for operators in compiled.rows:
+                for _, rules, _ in operators:
+                    for rule in rules:
+                        header_patterns = patterns.setdefault(rule.header_name, {})
+                        for pattern in rule.patterns:
+                            pattern_ids.setdefault(pattern.pattern, len(pattern_ids))
+                            header_patterns.setdefault(pattern_ids[pattern.pattern], pattern)
+                        rule.pattern_ids = frozenset(pattern_ids[pattern.pattern] for pattern in rule.patterns)
+        self.matchers = dict((header_name, HeaderMatcher(header_patterns)) for header_name, header_patterns in patterns.items())
+
+        # Positions of the filters per header they look at, filters without any rule never match
+        self.filters_by_header = {}
+        for position, compiled in enumerate(self.filters):
+            for header_name in compiled.header_names:
+                self.filters_by_header.setdefault(header_name, []).append(position)
+        self.header_names = sorted(self.filters_by_header)
+
+        # Decisions only depend on the filters and the values of the headers they look at
+        self.digest = hashlib.sha1(json.dumps(filters or {}, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        self.cache = cache
+
+    def __getitem__(self, name):
+        return self.filters_by_name[name]
+
+    def match_header(self, mail, header_name):
+        """
+        Return the ids of all patterns matching any value of a mail header
+        """
+        header_value = mail.get_header(header_name, None)
+        if header_value is None:
+            return set()
+
+        found = set()
+        for value in (header_value if isinstance(header_value, list) else [header_value]):
+            if value:
+                found.update(self.matchers[header_name].match(value.lower()))
+        return found
+
+    def get_header_names(self, mail):
+        """
+        Return the names of the headers of a mail that are looked at by any filter
+        """
+        return frozenset(header_name.lower() for header_name in mail.get_header_names()).intersection(self.filters_by_header)
+
+    def get_fingerprint(self, mail):
+        """
+        Return a hash of the values of all headers the filters look at
+        """
+        values = tuple(mail.get_header(header_name) for header_name in self.header_names)
+        return hashlib.sha1(repr(values).encode('utf-8', 'surrogateescape')).digest()
+
+    def first_match(self, mail):
+        """
+        Return the first filter matching a mail or None, looking up the decision in the cache first if there is one
+        """
+        if self.cache is None:
+            return self.evaluate(mail)
+
+        fingerprint = self.get_fingerprint(mail)
+        cached, filter_name = self.cache.get(self.digest, fingerprint)
+        if cached:
+            return None if filter_name is None else self.filters_by_name[filter_name]
+
+        compiled = self.evaluate(mail)
+        self.cache.set(self.digest, fingerprint, compiled.name if compiled else None)
+        return compiled
+
+    def evaluate(self, mail):
+        """
+        Return the first filter matching a mail or None, only filters looking at headers of the mail are evaluated and each
+        header is looked at once at most
+        """
+        header_names = self.get_header_names(mail)
+        matches = {}
+
+        def rule_match(rule):
+            if rule.header_name not in header_names:
+                return False
+            if rule.has_invalid_patterns:
+                return rule.match(mail)
+            if rule.header_name not in matches:
+                matches[rule.header_name] = self.match_header(mail, rule.header_name)
+            return not rule.pattern_ids.isdisjoint(matches[rule.header_name])
+
+        positions = set()
+        for header_name in header_names:
+            positions.update(self.filters_by_header[header_name])
+
+        for position in sorted(positions):
+            compiled = self.filters[position]
+            if compiled.match(mail, rule_match, header_names):
+                return compiled
+        return None
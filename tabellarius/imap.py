@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 sw=4 et
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from imapclient import IMAPClient, exceptions
+from imapclient.response_parser import parse_fetch_response
 from logging import DEBUG as loglevel_DEBUG
 from re import compile as regex_compile
 from sys import exc_info
 import ssl
-from time import sleep
+from time import sleep, time
 from traceback import print_exception
 import email
 
+from tabellarius.capabilities import Capabilities, Feature
 from tabellarius.mail import Mail
 from tabellarius.misc import Helper
 
@@ -21,6 +24,14 @@ class IMAP():
     """
     Retval = namedtuple('Retval', 'code data')
 
+    EXPUNGE_POLICIES = ('immediate', 'end_of_cycle', 'uid_only')
+
+    # UID commands that can be pipelined safely (RFC 3501, 5.5), none of them causes an EXPUNGE
+    PIPELINE_COMMANDS = ('FETCH', 'STORE')
+
+    # ESEARCH response (RFC 4731), e.g. (TAG "A5") UID ALL 1:3,5
+    ESEARCH_ALL_RE = regex_compile(r'\bALL ([0-9:,]+)')
+
     def __init__(self, logger, username, password,
                  server='localhost',
                  port=143,
@@ -28,7 +39,15 @@ class IMAP():
                  imaps=False,
                  tlsverify=True,
                  test=False,
-                 timeout=None):
+                 timeout=None,
+                 fetch_chunk_size=500,
+                 mailbox_cache_ttl=300,
+                 expunge_policy='immediate',
+                 pipeline_depth=8,
+                 fetch_connections=1,
+                 max_mails_in_flight=None,
+                 max_bytes_in_flight=None,
+                 message_id_index_size=10000):
         self.logger = logger
         self.username = username
         self.password = password
@@ -36,6 +55,7 @@ class IMAP():
         self.port = port
         self.imaps = imaps
         self.starttls = starttls
+        self.tlsverify = tlsverify
         self.timeout = timeout
 
         self.sslcontext = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
@@ -46,35 +66,89 @@ class IMAP():
             self.sslcontext.verify_mode = ssl.CERT_NONE
 
         self.test = test
+        self.fetch_chunk_size = fetch_chunk_size
+        self.pipeline_depth = max(pipeline_depth, 1)
         self.conn = None
 
+        # Limits of stream_mails, how many mails (and bytes of them) are held in memory at once
+        self.max_mails_in_flight = max_mails_in_flight
+        self.max_bytes_in_flight = max_bytes_in_flight
+
+        # Additional read-only connections to fetch large backlogs with
+        self.fetch_connections = max(fetch_connections, 1)
+        self.fetch_pool = []
+
+        # When to expunge mails that were moved by COPY/STORE: immediate, end_of_cycle (see flush_expunges) or uid_only
+        if expunge_policy not in self.EXPUNGE_POLICIES:
+            raise ValueError('Unsupported expunge policy {}'.format(expunge_policy))
+        self.expunge_policy = expunge_policy
+        self.pending_expunges = {}
+
+        # Names of existing mailboxes, refreshed every mailbox_cache_ttl seconds
+        self.mailbox_cache = None
+        self.mailbox_cache_time = 0
+        self.mailbox_cache_ttl = mailbox_cache_ttl
+
+        # Message-Id -> UID mapping per mailbox, only the message_id_index_size most recently used mails are kept per mailbox
+        self.message_id_index = {}
+        self.message_id_index_size = message_id_index_size
+        self.uidvalidity = {}
+
+        # Currently selected mailbox
+        self.selected_mailbox = None
+        self.selected_readonly = False
+        self.selected_state = None
+
+        # Server capabilities, refreshed after STARTTLS and LOGIN
+        self.capabilities = Capabilities()
+
+        # Change tracking (RFC 7162)
+        self.condstore = False
+
     def do_select_mailbox(func):
         """
-        Decorator to do a fresh mailbox SELECT
+        Decorator to make sure a mailbox is selected (read-write) before running a command
         """
         def wrapper(*args, **kwargs):
-            if len(args) != 1:
-                raise AttributeError(
-                    'Size of *args tuple "{0}" isn\'t 1. It looks like you haven\'t specified all '
-                    'method arguments as named arguments!'.format(
-                        args))
-
-            mailbox = None
-            for key in ['mailbox', 'source']:
-                if key in kwargs.keys():
-                    mailbox = kwargs[key]
-                    break
-
-            if mailbox is None:
-                raise KeyError('Unable to SELECT a mailbox, kwargs "{0}" doesn\'t contain a mailbox name'.format(kwargs))
-
-            result = args[0].select_mailbox(mailbox)
-            if not result.code:
-                raise RuntimeError(result.data)
+            args[0].__select_mailbox_from_args(args, kwargs, readonly=False)
             return func(*args, **kwargs)
 
         return wrapper
 
+    def do_examine_mailbox(func):
+        """
+        Decorator to make sure a mailbox is selected before running a read-only command, EXAMINE is sufficient
+        """
+        def wrapper(*args, **kwargs):
+            args[0].__select_mailbox_from_args(args, kwargs, readonly=True)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    def __select_mailbox_from_args(self, args, kwargs, readonly):
+        """
+        Select the mailbox given as named method argument
+        """
+        if len(args) != 1:
+            raise AttributeError(
+                'Size of *args tuple "{0}" isn\'t 1. It looks like you haven\'t specified all '
+                'method arguments as named arguments!'.format(
+                    args))
+
+        mailbox = None
+        for key in ['mailbox', 'source']:
+            if key in kwargs.keys():
+                mailbox = kwargs[key]
+                break
+
+        if mailbox is None:
+            raise KeyError('Unable to SELECT a mailbox, kwargs "{0}" doesn\'t contain a mailbox name'.format(kwargs))
+
+        result = self.select_mailbox(mailbox, readonly=readonly)
+        if not result.code:
+            raise RuntimeError(result.data)
+        return result
+
     def process_error(self, exception, simple_return=False):
         """
         Process Python exception by logging a message and optionally showing traceback
@@ -87,6 +161,10 @@ class IMAP():
 
         self.logger.error("Catching IMAP exception {}: {}".format(type(exception), err_msg))
 
+        # The server tells us that our idea of existing mailboxes is outdated
+        if '[TRYCREATE]' in err_msg or '[NONEXISTENT]' in err_msg:
+            self.mailbox_cache = None
+
         if self.logger.isEnabledFor(loglevel_DEBUG):
             print_exception(*trace_info)
         del trace_info
@@ -106,6 +184,7 @@ class IMAP():
         elif self.imaps:
             self.logger.debug('Establishing IMAP connection using SSL/{} (imaps) to {} and logging in with user {}'.format(self.port, self.server,
                                                                                                                            self.username))
+        self.selected_mailbox = None
         try:
             self.conn = IMAPClient(host=self.server,
                                    port=self.port,
@@ -116,9 +195,11 @@ class IMAP():
 
             if self.starttls:
                 self.conn.starttls(ssl_context=self.sslcontext)
+                self.refresh_capabilities()
 
             login = self.conn.login(self.username, self.password)
             login_response = Helper().byte_to_str(login)
+            self.refresh_capabilities()
 
             # Test login/auth status
             login_success = False
@@ -129,6 +210,8 @@ class IMAP():
             if logout:
                 return self.disconnect()
             elif login_success:
+                self.enable_condstore()
+                self.refresh_mailbox_cache()
                 return self.Retval(True, login_response)
             else:
                 return self.Retval(False, login_response)  # pragma: no cover
@@ -155,14 +238,97 @@ class IMAP():
             noop_resp_pattern_re = regex_compile('^(Success|NOOP completed)')
             login_success = noop_resp_pattern_re.match(noop_response)
             return self.Retval(True, login_success)
+        except (IMAPClient.Error, OSError) as e:
+            return self.process_error(e)
+
+    def enable_condstore(self):
+        """
+        Enable CONDSTORE (RFC 7162) if the server supports it, to be able to search for changed mails by MODSEQ
+        """
+        self.condstore = False
+        try:
+            if self.has_capability(Feature.CONDSTORE):
+                if self.has_capability(Feature.ENABLE):
+                    self.conn.enable('CONDSTORE')
+                self.condstore = True
+            self.logger.debug('Change tracking enabled: CONDSTORE={}'.format(self.condstore))
+            return self.Retval(True, self.condstore)
         except IMAPClient.Error as e:
             return self.process_error(e)
 
+    def refresh_capabilities(self):
+        """
+        Ask the server for its capabilities, they change after STARTTLS and LOGIN
+        """
+        try:
+            self.capabilities = Capabilities(self.conn.capabilities())
+            self.logger.debug('Server capabilities: {}'.format(' '.join(sorted(self.capabilities.raw))))
+            return self.Retval(True, self.capabilities)
+        except IMAPClient.Error as e:  # pragma: no cover
+            self.capabilities = Capabilities()  # pragma: no cover
+            return self.process_error(e)  # pragma: no cover
+
+    def has_capability(self, capability):
+        """
+        Check whether the server supports a capability (a Feature or its name), using the capabilities cached at login
+        """
+        return capability in self.capabilities
+
+    def socket(self):
+        """
+        Return the socket of the connection, e.g. to wait for IDLE responses of multiple connections at once
+        """
+        return self.conn._sock
+
+    def idle_start(self, mailbox):
+        """
+        Select a mailbox and start IDLE mode (RFC 2177) on it
+        """
+        self.logger.debug('Starting IDLE on mailbox {}'.format(mailbox))
+        result = self.select_mailbox(mailbox)
+        if not result.code:
+            return result
+
+        try:
+            return self.Retval(True, self.conn.idle())
+        except (IMAPClient.Error, OSError) as e:
+            return self.process_error(e)
+
+    def idle_check(self, timeout=None):
+        """
+        Return the responses that were sent by the server while IDLE (blocks at most timeout seconds)
+        """
+        try:
+            return self.Retval(True, self.conn.idle_check(timeout=timeout))
+        except (IMAPClient.Error, OSError) as e:
+            return self.process_error(e)
+
+    def idle_done(self):
+        """
+        Stop IDLE mode
+        """
+        self.logger.debug('Stopping IDLE')
+        try:
+            return self.Retval(True, self.conn.idle_done())
+        except (IMAPClient.Error, OSError) as e:
+            return self.process_error(e)
+
     def disconnect(self):
         """
         Disconnect from IMAP server
         """
-        result = self.conn.logout()
+        self.selected_mailbox = None
+        while self.fetch_pool:
+            self.fetch_pool.pop().disconnect()
+        try:
+            result = self.conn.logout()
+        except (IMAPClient.Error, OSError) as e:
+            # imaplib only closes the socket after a successful LOGOUT
+            try:
+                self.conn.shutdown()
+            except OSError:
+                pass
+            return self.process_error(e)
         response = Helper().byte_to_str(result)
         return self.Retval(response == 'Logging out', response)
 
@@ -184,13 +350,24 @@ class IMAP():
         except IMAPClient.Error as e:
             return self.process_error(e)
 
-    def select_mailbox(self, mailbox):
+    def select_mailbox(self, mailbox, readonly=False, force=False):
         """
-        Select a mailbox to work on
+        Select a mailbox to work on, readonly uses EXAMINE
+
+        The mailbox isn't selected again if it's selected already (in a sufficient mode), unless force is set.
         """
-        self.logger.debug('Switching to mailbox {}'.format(mailbox))
+        if self.test:
+            readonly = True
+
+        if not force and mailbox == self.selected_mailbox and (readonly or not self.selected_readonly):
+            return self.Retval(True, self.selected_state)
+
+        self.logger.debug('Switching to mailbox {} ({})'.format(mailbox, 'EXAMINE' if readonly else 'SELECT'))
+        # imaplib discards the untagged responses of the previous mailbox on SELECT
+        self.__drop_expunged_index()
+        self.selected_mailbox = None
         try:
-            result = self.conn.select_folder(mailbox)
+            result = self.conn.select_folder(mailbox, readonly=readonly)
             response = {}
             for key, value in result.items():
                 unicode_key = Helper().byte_to_str(key)
@@ -201,6 +378,16 @@ class IMAP():
                     response[unicode_key] = tuple(flags)
                 else:
                     response[unicode_key] = value
+
+            # UIDs are meaningless once UIDVALIDITY changes
+            if mailbox in self.uidvalidity and self.uidvalidity[mailbox] != response.get('UIDVALIDITY'):
+                self.message_id_index.pop(mailbox, None)
+                self.pending_expunges.pop(mailbox, None)
+            self.uidvalidity[mailbox] = response.get('UIDVALIDITY')
+
+            self.selected_mailbox = mailbox
+            self.selected_readonly = readonly
+            self.selected_state = response
             return self.Retval(True, response)
         except IMAPClient.Error as e:
             return self.process_error(e)
@@ -214,57 +401,219 @@ class IMAP():
             if not isinstance(message, Mail):
                 message = Mail(logger=self.logger, mail_native=message)
 
-            self.conn.append(mailbox, str(message.get_native()), flags, msg_time)
+            response = self.conn.append(mailbox, str(message.get_native()), flags, msg_time)
 
-            # According to rfc4315 we must not return the UID from the response, so we are fetching it ourselves
-            uids = self.search_mails(mailbox=mailbox, criteria='HEADER Message-Id "{}"'.format(message.get_message_id())).data[0]
+            # Take the UID from the APPENDUID response code (RFC 4315) and search for it only if the server doesn't send one
+            appenduid = self.__parse_uidplus_response([response], 'APPENDUID')
+            if appenduid:
+                uids = appenduid[0][0]
+            else:
+                uids = self.search_mails(mailbox=mailbox, criteria='HEADER Message-Id "{}"'.format(message.get_message_id())).data[0]
+            self.__index_message_ids(mailbox=mailbox, message_ids={message.get_message_id(): uids})
 
             return self.Retval(True, uids)
         except IMAPClient.Error as e:
             return self.process_error(e)
 
-    @do_select_mailbox
-    def search_mails(self, mailbox, criteria='ALL', autocreate_mailbox=False):
+    @do_examine_mailbox
+    def search_mails(self, mailbox, criteria='ALL', autocreate_mailbox=False, min_uid=None):
         """
-        Search for mails in a mailbox
+        Search for mails in a mailbox, optionally only for those having a UID of at least min_uid
         """
+        if min_uid is not None:
+            criteria = 'UID {}:* {}'.format(min_uid, criteria)
+
         self.logger.debug('Searching for mails in mailbox {} and criteria=\'{}\''.format(mailbox, criteria))
         try:
-            return self.Retval(True, list(self.conn.search(criteria=criteria)))
+            if self.has_capability(Feature.ESEARCH):
+                uids = self.__esearch(criteria)
+            else:
+                uids = list(self.conn.search(criteria=criteria))
+            if min_uid is not None:
+                # "n:*" always includes the highest UID of the mailbox, even if it's lower than n
+                uids = [uid for uid in uids if uid >= min_uid]
+            return self.Retval(True, uids)
         except IMAPClient.Error as e:
             return self.process_error(e)
 
-    @do_select_mailbox
-    def fetch_mails(self, uids, mailbox, return_fields=None):
+    def __esearch(self, criteria):
+        """
+        Search using ESEARCH (RFC 4731), the server returns the UIDs as compact sequence set instead of one number per mail
+        """
+        data = self.conn._raw_command_untagged(b'SEARCH', [b'RETURN', b'(ALL)', Helper().str_to_bytes(criteria)], response_name='ESEARCH')
+        match = self.ESEARCH_ALL_RE.search(Helper().byte_to_str(data[0] or b''))
+        if match is None:
+            return []
+        return Helper().sequence_set_to_uids(match.group(1))
+
+    @do_examine_mailbox
+    def fetch_mails(self, uids, mailbox, return_fields=None, headers=None):
         """
         Retrieve mails from a mailbox
+
+        If a list of header names is given, only these headers (plus Message-Id) are fetched instead of the whole mail
         """
         self.logger.debug('Fetching mails with uids {}'.format(uids))
 
         return_raw = True
         if return_fields is None:
             return_raw = False
-            return_fields = [b'RFC822']
+            if headers is None:
+                return_fields = [b'RFC822']
+            else:
+                header_names = sorted(set([header.upper() for header in headers] + ['MESSAGE-ID']))
+                return_fields = ['BODY.PEEK[HEADER.FIELDS ({})]'.format(' '.join(header_names))]
 
-        mails = {}
+        if self.fetch_connections > 1 and len(uids) > self.fetch_chunk_size:
+            return self.__fetch_mails_parallel(uids=uids, mailbox=mailbox, return_fields=return_fields, return_raw=return_raw, headers=headers)
+        return self.__fetch_mails(uids=uids, mailbox=mailbox, return_fields=return_fields, return_raw=return_raw)
+
+    def stream_mails(self, uids, mailbox, headers=None):
+        """
+        Retrieve mails batch by batch instead of all at once, yielding Retval(True, {uid: Mail}) per batch
+
+        Batches hold at most max_mails_in_flight mails and, when fetching whole mails, max_bytes_in_flight bytes (based on
+        RFC822.SIZE). A failed fetch is yielded as well and ends the stream.
+        """
+        sizes = None
+        if self.max_bytes_in_flight and headers is None:
+            result = self.get_mail_sizes(uids=uids, mailbox=mailbox)
+            if not result.code:
+                yield result
+                return
+            sizes = result.data
+
+        for batch in Helper().batches(uids, max_items=self.max_mails_in_flight, sizes=sizes, max_size=self.max_bytes_in_flight):
+            result = self.fetch_mails(uids=batch, mailbox=mailbox, headers=headers)
+            yield result
+            if not result.code:
+                return
+
+    @do_examine_mailbox
+    def get_mail_sizes(self, uids, mailbox):
+        """
+        Retrieve the sizes (RFC822.SIZE) of mails
+        """
         try:
-            for uid in uids:
-                result = self.conn.fetch(uid, return_fields)
+            sizes = {}
+            for chunks in Helper().chunks(Helper().chunks(uids, self.fetch_chunk_size), self.pipeline_depth):
+                result = self.pipeline([('FETCH', [Helper().uids_to_sequence_set(chunk), '(RFC822.SIZE)']) for chunk in chunks])
+                if not result.code:
+                    return result
+                sizes.update((uid, data.get(b'RFC822.SIZE', 0)) for uid, data in result.data.items())
+            return self.Retval(True, sizes)
+        except IMAPClient.Error as e:
+            return self.process_error(e)
 
-                if not result:
-                    continue
+    def __fetch_mails(self, uids, mailbox, return_fields, return_raw):
+        """
+        Retrieve mails from the selected mailbox using this connection only
+        """
+        fields = '({})'.format(' '.join(Helper().byte_to_str(field).upper() for field in return_fields))
 
-                if return_raw:
-                    mails[uid] = result[uid]
-                else:
-                    # mails[uid] = Mail(logger=self.logger, uid=uid, mail_native=email.message_from_bytes(result[uid][b'RFC822']))
-                    mails[uid] = Mail(logger=self.logger, mail_native=email.message_from_bytes(result[uid][b'RFC822']))
+        mails = {}
+        try:
+            # Fetch in batches using UID sets to save a round trip per mail, sending up to pipeline_depth batches at once
+            for chunks in Helper().chunks(Helper().chunks(uids, self.fetch_chunk_size), self.pipeline_depth):
+                result = self.pipeline([('FETCH', [Helper().uids_to_sequence_set(chunk), fields]) for chunk in chunks])
+                if not result.code:
+                    return result
+                result = result.data
+
+                for uid in [uid for chunk in chunks for uid in chunk]:
+                    if uid not in result:
+                        continue
+
+                    if return_raw:
+                        mails[uid] = result[uid]
+                    else:
+                        mail_native = email.message_from_bytes(self.__get_message_data(result[uid]))
+                        has_message_id = 'message-id' in mail_native
+                        mails[uid] = Mail(logger=self.logger, mail_native=mail_native, uid=uid)
+                        if has_message_id:
+                            self.__index_message_ids(mailbox=mailbox, message_ids={mails[uid].get_message_id(): uid})
             return self.Retval(True, mails)
 
         except IMAPClient.Error as e:
             return self.process_error(e)
 
-    @do_select_mailbox
+    def __fetch_mails_parallel(self, uids, mailbox, return_fields, return_raw, headers):
+        """
+        Retrieve a large number of mails by splitting their UIDs into ranges and fetching each range on its own connection
+        """
+        connections = [self] + self.__get_fetch_pool()
+        uids = sorted(uids)
+        ranges = list(Helper().chunks(uids, -(-len(uids) // len(connections))))
+        self.logger.debug('Fetching {} mails from mailbox {} using {} connections'.format(len(uids), mailbox, len(ranges)))
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = []
+            for imap, uid_range in zip(connections, ranges):
+                if imap is self:
+                    futures.append(executor.submit(self.__fetch_mails, uids=uid_range, mailbox=mailbox, return_fields=return_fields,
+                                                   return_raw=return_raw))
+                else:
+                    futures.append(executor.submit(imap.fetch_mails, uids=uid_range, mailbox=mailbox,
+                                                   return_fields=return_fields if return_raw else None, headers=headers))
+            results = [future.result() for future in futures]
+
+        mails = {}
+        for imap, uid_range, result in zip(connections, ranges, results):
+            if not result.code:
+                return result
+            mails.update(result.data)
+
+            # Mails fetched by the other connections are indexed there
+            if imap is not self:
+                index = imap.message_id_index.get(mailbox, {})
+                uid_range = set(uid_range)
+                self.__index_message_ids(mailbox=mailbox,
+                                         message_ids=dict((message_id, uid) for message_id, uid in index.items() if uid in uid_range))
+        return self.Retval(True, mails)
+
+    def __get_fetch_pool(self):
+        """
+        Return the additional connections used for fetching, (re)connecting them if necessary
+        """
+        for imap in [imap for imap in self.fetch_pool if not imap.noop().code]:
+            self.fetch_pool.remove(imap)
+
+        while len(self.fetch_pool) < self.fetch_connections - 1:
+            imap = IMAP(logger=self.logger,
+                        username=self.username,
+                        password=self.password,
+                        server=self.server,
+                        port=self.port,
+                        starttls=self.starttls,
+                        imaps=self.imaps,
+                        tlsverify=self.tlsverify,
+                        test=True,  # read-only
+                        timeout=self.timeout,
+                        fetch_chunk_size=self.fetch_chunk_size,
+                        mailbox_cache_ttl=self.mailbox_cache_ttl,
+                        pipeline_depth=self.pipeline_depth,
+                        message_id_index_size=self.message_id_index_size)
+            result = imap.connect()
+            if not result.code:
+                self.logger.error('Failed to open an additional connection for fetching mails, using {} only: {}'.format(
+                    len(self.fetch_pool) + 1, result.data))
+                break
+            self.fetch_pool.append(imap)
+        return self.fetch_pool
+
+    def __get_message_data(self, fetch_data):
+        """
+        Return the (partial) message from a FETCH response, no matter whether RFC822 or BODY[HEADER.FIELDS (...)] was requested
+        """
+        if b'RFC822' in fetch_data:
+            return fetch_data[b'RFC822']
+
+        for key, value in fetch_data.items():
+            if key.startswith(b'BODY[HEADER'):
+                return value
+        return b''
+
+    @do_examine_mailbox
     def get_mailflags(self, uids, mailbox):
         """
         Retrieve flags from mails
@@ -310,6 +659,24 @@ class IMAP():
             except IMAPClient.Error as e:
                 return self.process_error(e)
 
+    @do_select_mailbox
+    def set_mailflags_many(self, mailbox, flag_sets):
+        """
+        Set flags on several sets of mails ({flags: uids}) at once, without retrieving them
+        """
+        if self.test:
+            self.logger.info('Would have set mail flags {}'.format(flag_sets))
+            return self.Retval(True, None)
+
+        self.logger.debug('Setting flags on mails: {}'.format(flag_sets))
+        commands = [('STORE', [Helper().uids_to_sequence_set(uids), 'FLAGS.SILENT', '({})'.format(' '.join(flags))])
+                    for flags, uids in flag_sets.items() if uids]
+        for commands in Helper().chunks(commands, self.pipeline_depth):
+            result = self.pipeline(commands)
+            if not result.code:
+                return result
+        return self.Retval(True, None)
+
     @do_select_mailbox
     def add_mailflags(self, uids, mailbox, flags=[]):
         """
@@ -336,11 +703,12 @@ class IMAP():
                 return self.process_error(e)
 
     @do_select_mailbox
-    def move_mail(self, message_ids, source, destination, delete_old=True, expunge=True, add_flags=None, set_flags=None):
+    def move_mail(self, source, destination, message_ids=None, uids=None, delete_old=True, expunge=True, add_flags=None, set_flags=None):
         """
         Move a mail from a mailbox to another
         """
         return self.copy_mails(message_ids=message_ids,
+                               uids=uids,
                                source=source,
                                destination=destination,
                                delete_old=delete_old,
@@ -349,32 +717,24 @@ class IMAP():
                                set_flags=set_flags)
 
     @do_select_mailbox
-    def copy_mails(self, source, destination, message_ids=None, delete_old=False, expunge=False, add_flags=None, set_flags=None):
+    def copy_mails(self, source, destination, message_ids=None, uids=None, delete_old=False, expunge=False, add_flags=None, set_flags=None):
         """
-        Copies one or more mails from a mailbox into another
+        Copies one or more mails (by Message-Id or UID) from a mailbox into another
         """
         if self.test:
             if delete_old:
-                self.logger.info('Would have moved mail Message-Ids="{}" from "{}" to "{}", skipping because of beeing in testmode'.format(
-                    message_ids, source, destination))
+                self.logger.info('Would have moved mail Message-Ids="{}"/uids="{}" from "{}" to "{}", skipping because of beeing in testmode'.format(
+                    message_ids, uids, source, destination))
             else:
-                self.logger.info('Would have copied mails with Message-Ids="{}" from "{}" to "{}", skipping because of beeing in testmode'.format(
-                    message_ids, source, destination))
+                self.logger.info('Would have copied mails with Message-Ids="{}"/uids="{}" from "{}" to "{}", skipping because of beeing in testmode'.format(
+                    message_ids, uids, source, destination))
             return self.Retval(True, None)
         else:
             try:
                 if delete_old:
-                    self.logger.debug('Moving mail Message-Ids="{}" from "{}" to "{}"'.format(message_ids, source, destination))
+                    self.logger.debug('Moving mail Message-Ids="{}"/uids="{}" from "{}" to "{}"'.format(message_ids, uids, source, destination))
                 else:
-                    self.logger.debug('Copying mail Message-Ids="{}" from "{}" to "{}"'.format(message_ids, source, destination))
-
-                # if message_ids is None:
-                #    message_ids = []
-                #    result = self.fetch_mails(uids=uids, mailbox=source)
-                #    if not result.code:
-                #        self.logger.error('Failed to determine Message-Id by uids for mail with uids "{}"', uids)
-                #        return result
-                #    message_ids.append(result.data.keys())
+                    self.logger.debug('Copying mail Message-Ids="{}"/uids="{}" from "{}" to "{}"'.format(message_ids, uids, source, destination))
 
                 if not self.mailbox_exists(destination).data:
                     self.logger.info('Destination mailbox {} doesn\'t exist, creating it for you'.format(destination))
@@ -384,42 +744,63 @@ class IMAP():
                         self.logger.error('Failed to create the mailbox {}: {}'.format(source, result.data))  # pragma: no cover
                         return result  # pragma: no cover
 
-                uids = []
-                for message_id in message_ids:
-                    result = self.search_mails(mailbox=source, criteria='HEADER Message-Id "{}"'.format(message_id))
-
-                    if not result.code or len(result.data) == 0:
-                        self.logger.error('Failed to determine uid by Message-Id for mail with Message-Id "{}"'.format(message_id))
-                        return self.Retval(False, result.data)
-                    uids.append(result.data[0])
+                if uids is None:
+                    result = self.__resolve_message_ids(mailbox=source, message_ids=message_ids)
+                    if not result.code:
+                        return result
+                    uids = result.data
+                else:
+                    uids = list(uids)
+                    # The Message-Ids are needed to find the copied mails if the server doesn't send COPYUID
+                    message_ids = self.__get_message_ids(mailbox=source, uids=uids, fetch=not self.has_capability(Feature.UIDPLUS))
 
                 result = self.select_mailbox(source)
                 if not result.code:
                     return result  # pragma: no cover
 
-                self.conn.copy(uids, destination)
+                # Atomic move (RFC 6851), no need to flag and expunge the old mails afterwards
+                native_move = delete_old and self.has_capability(Feature.MOVE)
+                # imaplib keeps the COPYUID response code (untagged OK for MOVE, tagged OK for COPY) until it's popped
+                self.conn._imap.untagged_responses.pop('COPYUID', None)
+                if native_move:
+                    self.conn.move(uids, destination)
+                else:
+                    self.conn.copy(uids, destination)
+                responses = [b'[COPYUID ' + data + b']' for data in self.conn._imap.untagged_responses.pop('COPYUID', []) if data]
+                copyuid = self.__parse_uidplus_response(responses, 'COPYUID')
+                uid_map = dict(zip(*copyuid)) if copyuid else {}
 
-                if delete_old:
+                if delete_old and not native_move:
                     result = self.delete_mails(uids=uids, mailbox=source)
                     if not result.code:
                         self.logger.error('Failed to remove old mail with Message-Id="{}"/uids="{}": {}'.format(message_ids, uids,
                                                                                                                 result.data))  # pragma: no cover
                         return result  # pragma: no cover
 
-                    if expunge:  # TODO don't expunge by default
-                        result = self.expunge(mailbox=source)
+                    if expunge and self.expunge_policy == 'end_of_cycle':
+                        # Expunged once per mailbox by flush_expunges()
+                        self.pending_expunges.setdefault(source, []).extend(uids)
+                    elif expunge:
+                        result = self.__expunge_moved(mailbox=source, uids=uids)
                         if not result.code:
-                            self.logger.error('Failed to expunge on mailbox {}: {}'.format(source, result.data))  # pragma: no cover
                             return result  # pragma: no cover
 
-                dest_uids = []
-                for message_id in message_ids:
-                    result = self.search_mails(mailbox=destination, criteria='HEADER Message-Id "{}"'.format(message_id))
-                    if not result.code:
-                        self.logger.error('Failed to determine uid by Message-Id for mail with Message-Id "{}"'.format(
-                            message_id))  # pragma: no cover
-                        return result  # pragma: no cover
-                    dest_uids.append(result.data[0])
+                if all(uid in uid_map for uid in uids):
+                    dest_uids = [uid_map[uid] for uid in uids]
+                else:
+                    # Search for the new UIDs if the server doesn't support UIDPLUS
+                    dest_uids = []
+                    for message_id in message_ids:
+                        result = self.search_mails(mailbox=destination, criteria='HEADER Message-Id "{}"'.format(message_id))
+                        if not result.code or len(result.data) == 0:
+                            self.logger.error('Failed to determine uid in {} by Message-Id for mail with Message-Id "{}"'.format(
+                                destination, message_id))
+                            return self.Retval(False, result.data)
+                        dest_uids.append(result.data[0])
+
+                if delete_old:
+                    self.__unindex_uids(mailbox=source, uids=uids)
+                self.__index_message_ids(mailbox=destination, message_ids=dict(zip(message_ids, dest_uids)))
 
                 if isinstance(set_flags, list):
                     self.set_mailflags(uids=dest_uids, mailbox=destination, flags=set_flags)
@@ -431,13 +812,171 @@ class IMAP():
             except IMAPClient.Error as e:
                 return self.process_error(e)
 
+    def pipeline(self, commands):
+        """
+        Send several independent UID commands ([(command, args)]) to the selected mailbox at once and wait for all their
+        tagged responses afterwards, instead of waiting for a round trip per command
+
+        Only UID FETCH and UID STORE are supported: UID commands don't suffer from the message sequence number ambiguity
+        (RFC 3501, 5.5) and neither of them expunges. The commands must not depend on each other (e.g. STORE and FETCH on the same mails).
+        Returns the (parsed) untagged FETCH responses of all commands.
+        """
+        for command, args in commands:
+            if command.upper() not in self.PIPELINE_COMMANDS:
+                raise ValueError('Command {} can\'t be pipelined'.format(command))
+
+        try:
+            tags = [self.conn._imap._command('UID', command.upper(), *args) for command, args in commands]
+
+            # Collect all tagged responses first, so that no response is left on the wire if one of the commands failed
+            responses = []
+            for tag in tags:
+                try:
+                    responses.append(self.conn._imap._command_complete('UID', tag))
+                except IMAPClient.AbortError:
+                    raise
+                except IMAPClient.Error as e:  # BAD responses are raised by imaplib
+                    responses.append(('BAD', [str(e)]))
+            for (command, args), (typ, data) in zip(commands, responses):
+                if typ != 'OK':
+                    raise exceptions.IMAPClientError('{} failed: {}'.format(command, Helper().byte_to_str(data[0])))
+
+            typ, data = self.conn._imap._untagged_response('OK', [None], 'FETCH')
+            return self.Retval(True, parse_fetch_response(data, self.conn.normalise_times, True) if data != [None] else {})
+        except IMAPClient.Error as e:
+            return self.process_error(e)
+
+    def __index_message_ids(self, mailbox, message_ids):
+        """
+        Remember the UIDs of mails ({Message-Id: uid}) in a mailbox, forgetting the least recently used ones beyond message_id_index_size
+        """
+        index = self.message_id_index.setdefault(mailbox, OrderedDict())
+        for message_id, uid in message_ids.items():
+            if message_id is not None:
+                index[message_id] = uid
+                index.move_to_end(message_id)
+        while len(index) > self.message_id_index_size:
+            index.popitem(last=False)
+        return index
+
+    def __unindex_uids(self, mailbox, uids):
+        """
+        Forget mails that were removed from a mailbox
+        """
+        index = self.message_id_index.get(mailbox, {})
+        uids = set(uids)
+        for message_id in [message_id for message_id, uid in index.items() if uid in uids]:
+            del index[message_id]
+        return index
+
+    def __drop_expunged_index(self):
+        """
+        Forget the indexed mails of the selected mailbox if the server reported that mails were removed (EXPUNGE, VANISHED)
+        """
+        if self.conn is None:
+            return
+        responses = self.conn._imap.untagged_responses
+        if any([responses.pop('EXPUNGE', None), responses.pop('VANISHED', None)]) and self.selected_mailbox is not None:
+            self.message_id_index.pop(self.selected_mailbox, None)
+
+    def __resolve_message_ids(self, mailbox, message_ids):
+        """
+        Return the UIDs of mails by their Message-Ids, searching on the server only for mails that aren't indexed yet
+        """
+        self.__drop_expunged_index()
+
+        # Other clients may have expunged or moved indexed mails without this connection seeing it, only use UIDs that still exist
+        index = self.message_id_index.get(mailbox, {})
+        indexed_uids = [index[message_id] for message_id in message_ids if message_id in index]
+        if indexed_uids:
+            result = self.search_mails(mailbox=mailbox, criteria='UID {}'.format(Helper().uids_to_sequence_set(indexed_uids)))
+            if not result.code:
+                return result
+            index = self.__unindex_uids(mailbox=mailbox, uids=set(indexed_uids) - set(result.data))
+
+        uids = []
+        for message_id in message_ids:
+            if message_id in index:
+                index.move_to_end(message_id)
+                uids.append(index[message_id])
+                continue
+
+            result = self.search_mails(mailbox=mailbox, criteria='HEADER Message-Id "{}"'.format(message_id))
+            if not result.code or len(result.data) == 0:
+                self.logger.error('Failed to determine uid by Message-Id for mail with Message-Id "{}"'.format(message_id))
+                return self.Retval(False, result.data)
+            uids.append(result.data[0])
+        return self.Retval(True, uids)
+
+    def __get_message_ids(self, mailbox, uids, fetch=True):
+        """
+        Return the Message-Ids of mails by their UIDs, optionally fetching them from the server for mails that aren't indexed yet
+        """
+        message_ids = dict((uid, message_id) for message_id, uid in self.message_id_index.get(mailbox, {}).items())
+
+        missing_uids = [uid for uid in uids if uid not in message_ids]
+        if fetch and missing_uids:
+            result = self.fetch_mails(uids=missing_uids, mailbox=mailbox, headers=[])
+            if result.code:
+                for uid, mail in result.data.items():
+                    message_ids[uid] = mail.get_message_id()
+        return [message_ids.get(uid) for uid in uids]
+
+    def __parse_uidplus_response(self, responses, code):
+        """
+        Return the UID sets of a COPYUID or APPENDUID response code (RFC 4315) as lists of UIDs or None if there is none
+        """
+        response_code_re = regex_compile(r'\[{} \d+ ([0-9:,]+)(?: ([0-9:,]+))?\]'.format(code))
+        for response in responses:
+            match = response_code_re.search(Helper().byte_to_str(response))
+            if match:
+                return [Helper().sequence_set_to_uids(uid_set) for uid_set in match.groups() if uid_set is not None]
+        return None
+
+    def __expunge_moved(self, mailbox, uids):
+        """
+        Expunge mails that were copied to another mailbox and flagged as deleted
+        """
+        # Only expunge the moved mails if possible (RFC 4315), so other clients' deleted mails are kept
+        if self.has_capability(Feature.UIDPLUS):
+            result = self.expunge(mailbox=mailbox, uids=uids)
+        elif self.expunge_policy == 'uid_only':
+            self.logger.debug('Server doesn\'t support UID EXPUNGE, leaving mails with uids {} in mailbox {}'.format(uids, mailbox))
+            return self.Retval(True, False)
+        else:
+            result = self.expunge(mailbox=mailbox)
+        if not result.code:
+            self.logger.error('Failed to expunge on mailbox {}: {}'.format(mailbox, result.data))  # pragma: no cover
+        return result
+
+    def flush_expunges(self):
+        """
+        Expunge all mails collected by the end_of_cycle expunge policy, with one EXPUNGE per mailbox
+        """
+        expunged = {}
+        while self.pending_expunges:
+            mailbox, uids = self.pending_expunges.popitem()
+            result = self.__expunge_moved(mailbox=mailbox, uids=uids)
+            if not result.code:
+                return result  # pragma: no cover
+            expunged[mailbox] = uids
+        return self.Retval(True, expunged)
+
     @do_select_mailbox
-    def expunge(self, mailbox):
+    def expunge(self, mailbox, uids=None):
         """
-        Expunge mails form a mailbox
+        Expunge mails form a mailbox, optionally only those with the given UIDs (requires UIDPLUS)
         """
         self.logger.debug('Expunge mails from mailbox {}'.format(mailbox))
         try:
+            if uids:
+                self.logger.debug('Expunge mails with uids {} only'.format(uids))
+                self.conn.expunge(uids)
+                self.__unindex_uids(mailbox=mailbox, uids=uids)
+                return self.Retval(True, True)
+
+            # EXPUNGE responses contain sequence numbers only, so we don't know which mails were removed
+            self.message_id_index.pop(mailbox, None)
             return self.Retval(True, b'Expunge completed.' in self.conn.expunge())
         except IMAPClient.Error as e:  # pragma: no cover
             return self.process_error(e)  # pragma: no cover
@@ -448,14 +987,43 @@ class IMAP():
         """
         self.logger.debug('Creating mailbox {}'.format(mailbox))
         try:
-            return self.Retval(True, self.conn.create_folder(mailbox) == b'Create completed.')
+            created = self.conn.create_folder(mailbox) == b'Create completed.'
+            if self.mailbox_cache is not None:
+                self.mailbox_cache.add(mailbox)
+            return self.Retval(True, created)
         except IMAPClient.Error as e:
+            # Another client created the mailbox after the cache was refreshed (RFC 5530)
+            if '[ALREADYEXISTS]' in Helper().byte_to_str(e.args[0]):
+                self.logger.debug('Mailbox {} exists already, refreshing the mailbox cache'.format(mailbox))
+                self.refresh_mailbox_cache()
+                return self.Retval(True, False)
             return self.process_error(e)
 
+    def refresh_mailbox_cache(self):
+        """
+        Fetch the names of all mailboxes with a single LIST command
+        """
+        result = self.list_mailboxes()
+        if not result.code:
+            self.mailbox_cache = None
+            return result
+
+        self.mailbox_cache = set(mailbox['name'] for mailbox in result.data)
+        self.mailbox_cache_time = time()
+        return self.Retval(True, self.mailbox_cache)
+
     def mailbox_exists(self, mailbox):
         """
         Check whether a mailbox exists
         """
+        if self.mailbox_cache is None or time() - self.mailbox_cache_time >= self.mailbox_cache_ttl:
+            self.refresh_mailbox_cache()
+
+        if self.mailbox_cache is not None:
+            if mailbox.upper() == 'INBOX':
+                mailbox = 'INBOX'
+            return self.Retval(True, mailbox in self.mailbox_cache)
+
         try:
             return self.Retval(True, self.conn.folder_exists(mailbox))
         except IMAPClient.Error as e:  # pragma: no cover
@@ -15,14 +15,19 @@ class Mail():
     A dict representing a mail
     """
 
-    def __init__(self, logger, charset='utf-8', headers={}, body='', mail_native=None):
+    def __init__(self, logger, charset='utf-8', headers={}, body='', mail_native=None, uid=None):
         self.logger = logger
         self.charset = charset
         self.mail_native = mail_native
+        self.uid = uid
 
         self._headers = CaseInsensitiveDict(headers)
         self._body = body
 
+        # Headers and body of mail_native are decoded when they are read for the first time: {lowercased name: [field names]}
+        self._undecoded_headers = {}
+        self._undecoded_body = False
+
         if mail_native:
             self.__parse_native_mail()
 
@@ -41,19 +46,26 @@ class Mail():
         """
         Set mail header
         """
+        self._undecoded_headers.pop(name.lower(), None)
         self._headers[name] = value
         return self._headers
 
     def get_header(self, name, default=None):
         """
-        Return mail header by name
+        Return mail header by name, decoding it on first access
         """
-        return self._headers.get(name.lower(), default)
+        name = name.lower()
+        if name in self._undecoded_headers:
+            for field_name in self._undecoded_headers.pop(name):
+                self._headers[field_name] = self.__decode_header(field_name)
+        return self._headers.get(name, default)
 
     def update_headers(self, headers):
         """
         Update mail headers
         """
+        for name in headers:
+            self._undecoded_headers.pop(name.lower(), None)
         self._headers.update(headers)
         return self._headers
 
@@ -61,19 +73,35 @@ class Mail():
         """
         Get all mail headers
         """
+        for name in list(self._undecoded_headers):
+            self.get_header(name)
         return self._headers
 
+    def get_header_names(self):
+        """
+        Return the names of all mail headers without decoding them
+        """
+        return list(self._headers.keys())
+
     def set_body(self, body):
         """
         Set mail body
         """
+        self._undecoded_body = False
         self._body = body
         return self._body
 
     def get_body(self):
         """
-        Return mail body
+        Return mail body, decoding it on first access
         """
+        if self._undecoded_body:
+            self._undecoded_body = False
+            charset = self.mail_native.get_content_charset()
+            if python_version[1] == 2 or charset is None:
+                self._body = self.mail_native.get_payload()  # pragma: no cover
+            else:
+                self._body = self.mail_native.get_payload(decode=True).decode(charset)
         return self._body
 
     def get_native(self):
@@ -118,43 +146,31 @@ class Mail():
 
     def __parse_native_mail(self):
         """
-        Parses a native (email.message.Message()) object
+        Parses a native (email.message.Message()) object, the headers and the body are only decoded when needed
         """
         self._headers = CaseInsensitiveDict()
         self._body = ''
 
-        if not self.mail_native.is_multipart():  # TODO handle multipart mails
-            charset = self.mail_native.get_content_charset()
-            if python_version[1] == 2 or charset is None:
-                self.set_body(self.mail_native.get_payload())  # pragma: no cover
-            else:
-                self.set_body(self.mail_native.get_payload(decode=True).decode(charset))
+        self._undecoded_body = not self.mail_native.is_multipart()  # TODO handle multipart mails
 
         for field_name in self.mail_native.keys():
             if field_name in self._headers.keys():
                 continue
-            field_value = self.mail_native.get_all(field_name)
-
-            # Change parsing behaviour for headers that could contain encoded strings
-            if field_name in ['Subject', 'From', 'To', 'Cc', 'Bcc']:
-                field_value = str(email.header.make_header(email.header.decode_header(self.mail_native.get(field_name))))
-                #if isinstance(field_value, list):
-                #    field_value_list = field_value
-                #    field_value = ''
-                #    for val in field_value_list:
-                #        if val[1]:
-                #            field_value += self.clean_value(val[0], val[1])
-                #        elif isinstance(val[0], bytes):
-                #            field_value += self.clean_value(val[0])
-                #        else:
-                #            field_value += val[0]
-                #else:
-                #    field_value = self.clean_value(field_value[0][0], field_value[0][1])
-                self._headers[field_name] = field_value
-            elif len(field_value) > 1:
-                self._headers[field_name] = field_value
-            else:
-                self._headers[field_name] = field_value[0]
+            self._headers[field_name] = None
+            self._undecoded_headers.setdefault(field_name.lower(), []).append(field_name)
 
         if 'message-id' not in [header.lower() for header in self.mail_native.keys()]:
             self.reset_message_id(target='native')
+
+    def __decode_header(self, field_name):
+        """
+        Decodes a header of the native object
+        """
+        # Change parsing behaviour for headers that could contain encoded strings
+        if field_name in ['Subject', 'From', 'To', 'Cc', 'Bcc']:
+            return str(email.header.make_header(email.header.decode_header(self.mail_native.get(field_name))))
+
+        field_value = self.mail_native.get_all(field_name)
+        if len(field_value) > 1:
+            return field_value
+        return field_value[0]
@@ -1,111 +1,87 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 sw=4 et
 
-from re import compile as regex_compile
+from tabellarius.filter_program import CompiledFilter, CompiledPattern, CompiledRule
 
 
 class MailFilter():
-    def __init__(self, logger, imap, mail, config, mailbox, test=False):
+    """
+    Evaluates a filter against a mail and applies its commands, the rules are compiled once (see FilterProgram)
+    """
+
+    # Commands that can be applied without knowing more than the mail headers
+    HEADER_ONLY_COMMANDS = ('move',)
+
+    def __init__(self, logger, imap, mail, config, mailbox, test=False, plan=None, compiled=None):
         self.logger = logger
         self.imap = imap
         self.mail = mail
         self.config = config
         self.mailbox = mailbox
         self.test = test
+        self.plan = plan
+
+        self.compiled = compiled
+        if self.compiled is None and config is not None:
+            self.compiled = CompiledFilter(name=None, config=config)
+
+    @staticmethod
+    def get_header_names(filters):
+        """
+        Return the names of all mail headers referenced by filter rules or None if any filter command needs the whole mail
+        """
+        header_names = set()
+        for filter_settings in filters.values():
+            for command in filter_settings.get('commands', []):
+                if command.get('type') not in MailFilter.HEADER_ONLY_COMMANDS:
+                    return None
+
+            for row in filter_settings.get('rules', []):
+                for rules in row.values():
+                    for rule in rules:
+                        header_names.update(header_name.lower() for header_name in rule.keys())
+        return sorted(header_names)
 
     def check_rules_match(self):
         """
         Check filter rules against a mail
         """
-        match = False
-        for row in self.config.get('rules'):
-            for left, right in row.items():
-                if left == 'or':
-                    match = False
-                    for rule in right:
-                        match = self.check_rule_match(rule)
-                        if match:
-                            break
-
-                elif left == 'and':
-                    match = False
-                    for rule in right:
-                        match = self.check_rule_match(rule)
-                        if not match:
-                            break
-                else:
-                    raise NotImplementedError('Sorry, operator \'{0}\' isn\'t supported yet!'.format(left))
-            if match:
-                break
-
+        match = self.compiled.match(self.mail)
         if match:
-            if not self.test:
-                log_suffix = 'going to apply configured commands now.'
-            else:
-                log_suffix = 'not going to apply configured commands now (disabled).'
-            self.logger.info('Found rule match for mail with message-id={}, {}'.format(self.mail.get_message_id(), log_suffix))
-
-            if not self.test:
-                commands = self.config.get('commands')
-                result = self.apply_commands(commands)
-                if not result:
-                    raise RuntimeError('Failed to apply commands \'%s\'', commands)
+            self.process_match()
         return match
 
-    def check_rule_match(self, rule):
+    def process_match(self):
         """
-        Check a particular filter rule against a mail
+        Apply the commands of the filter to the mail that matched it (unless testing)
         """
-        header_name = next(iter(rule)).lower()
-        header_pattern_list = rule[next(iter(rule))]
-        header_value = self.mail.get_header(header_name, None)
-
-        # Skip if that header doesn't exist in the mail
-        if header_value is None:
-            return False
-
-        self.logger.debug('Process rule with field name \'{}\' matches patterns \'{}\''.format(header_name, header_pattern_list))
+        if not self.test:
+            log_suffix = 'going to apply configured commands now.'
+        else:
+            log_suffix = 'not going to apply configured commands now (disabled).'
+        self.logger.info('Found rule match for mail with message-id={}, {}'.format(self.mail.get_message_id(), log_suffix))
 
-        for pattern in header_pattern_list:
-            if isinstance(header_value, list):
-                for single_header_value in header_value:
-                    if self.check_match(single_header_value, pattern):
-                        return True
-            else:
-                if self.check_match(header_value, pattern):
-                    return True
+        if not self.test:
+            commands = self.config.get('commands')
+            result = self.apply_commands(commands)
+            if not result:
+                raise RuntimeError('Failed to apply commands \'%s\'', commands)
 
-        return False
+    def check_rule_match(self, rule):
+        """
+        Check a particular filter rule against a mail
+        """
+        return CompiledRule(rule).match(self.mail)
 
     def check_match(self, string, pattern):
         """
         Test whether a string matches a string pattern
         """
-        if string is None or len(string) == 0:
-            return False
-
-        string = string.lower()
-        pattern = pattern.lower()
-
-        self.logger.debug('Checking whether string pattern \'{}\' matches to string \'{}\''.format(pattern, string))
-
-        # Basic match
-        if pattern in string:
-            self.logger.debug('Pattern matches!')
-            return True
-
-        # RegEx match
-        pattern_re = regex_compile(pattern)
-        if pattern_re.match(string):
-            self.logger.debug('Pattern matches!')
-            return True
-        else:
-            self.logger.debug('Pattern does NOT match!')
-            return False
+        return CompiledPattern(pattern).match(string.lower() if string else string)
 
     def apply_commands(self, commands):
         """
-        Apply commands to mails
+        Apply commands to mails (or add them to the action plan if there is one)
         """
         self.logger.info('Applying commands (%s) to mail message-id="%s"', commands, self.mail.get_message_id())
         for command in commands:
@@ -114,7 +90,14 @@ class MailFilter():
             cmd_flags_add = command.get('add_flags', None)
 
             result = None
-            if cmd_type == 'move':
+            if cmd_type == 'move' and self.plan is not None:
+                self.plan.move(uid=self.mail.uid,
+                               message_id=self.mail.get_message_id(),
+                               destination=command.get('target'),
+                               add_flags=cmd_flags_add,
+                               set_flags=cmd_flags_set)
+                result = (True, None)
+            elif cmd_type == 'move':
                 cmd_target = command.get('target')
                 result = self.imap.move_mail(message_ids=[self.mail.get_message_id()],
                                              source=self.mailbox,
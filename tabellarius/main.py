@@ -3,14 +3,23 @@
 # vim: ts=4 sw=4 et
 
 from argparse import ArgumentParser
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
 from getpass import getpass
+from re import IGNORECASE, compile as regex_compile
+from select import select
 from sys import stderr, exc_info, version_info as python_version
-from time import sleep
+from time import sleep, time
 from traceback import print_exception
 
+from tabellarius.action_plan import ActionPlan
+from tabellarius.capabilities import Feature
+from tabellarius.checkpoint import Checkpoint
+from tabellarius.connection_manager import ConnectionManager
+from tabellarius.filter_program import DecisionCache, FilterProgram
 from tabellarius.imap import IMAP
 from tabellarius.mail_filter import MailFilter
-from tabellarius.misc import ConfigParser, Helper
+from tabellarius.misc import AccountLoggerAdapter, ConfigParser, Helper
 
 __version__ = '2.3.0'
 
@@ -101,9 +110,25 @@ def main():
                             binary=config.get('settings').get('gpg_binary', 'gpg2'))
             gpg.encoding = 'utf-8'
 
+    # The asyncio backend handles all accounts within a single thread, but requires aioimaplib
+    backend = config.get('settings').get('backend', 'imapclient')
+    if backend == 'asyncio':
+        from tabellarius.aioimap import AsyncIMAP
+
+        # aioimaplib can't upgrade a connection with STARTTLS, such accounts would never connect
+        starttls_accounts = sorted(acc_id for acc_id, acc_settings in config.get('accounts').items() if acc_settings.get('starttls', True))
+        if starttls_accounts:
+            print('ERROR: The asyncio backend doesn\'t support STARTTLS, please set starttls to false (and use imaps) for the accounts: {}'.format(
+                ', '.join(starttls_accounts)))
+            exit(127)
+
     # Initialize connection pools
     imap_pool = {}
+    managers = {}
+    acc_loggers = {}
     for acc_id, acc_settings in sorted(config.get('accounts').items()):
+        acc_loggers[acc_id] = AccountLoggerAdapter(logger, {'account': acc_id})
+
         # Check whether we got a plaintext password
         acc_password = acc_settings.get('password')
         if not acc_password:
@@ -123,102 +148,481 @@ def main():
                 acc_password = getpass('Please enter the IMAP password for {0} ({1}): '.format(acc_id, acc_settings.get('username')))
 
         logger.info('%s: Setting up IMAP connection', acc_settings.get('username'))
-        imap_pool[acc_id] = IMAP(logger=logger,
-                                 server=acc_settings.get('server'),
-                                 port=acc_settings.get('port', 143),
-                                 starttls=acc_settings.get('starttls', True),
-                                 imaps=acc_settings.get('imaps', False),
-                                 tlsverify=acc_settings.get('tlsverify', True),
-                                 username=acc_settings.get('username'),
-                                 password=acc_password,
-                                 test=test)
-        connect = imap_pool[acc_id].connect()
-
+        imap_settings = {'logger': acc_loggers[acc_id],
+                         'server': acc_settings.get('server'),
+                         'port': acc_settings.get('port', 143),
+                         'starttls': acc_settings.get('starttls', True),
+                         'imaps': acc_settings.get('imaps', False),
+                         'tlsverify': acc_settings.get('tlsverify', True),
+                         'username': acc_settings.get('username'),
+                         'password': acc_password,
+                         'test': test,
+                         # Socket timeout, so that half-open connections (e.g. dropped by a NAT device) fail instead of hanging
+                         'timeout': config.get('settings').get('timeout', 60),
+                         'fetch_chunk_size': config.get('settings').get('fetch_chunk_size', 500),
+                         'mailbox_cache_ttl': config.get('settings').get('mailbox_cache_ttl', 300),
+                         'expunge_policy': config.get('settings').get('expunge_policy', 'immediate'),
+                         'max_mails_in_flight': config.get('settings').get('max_mails_in_flight'),
+                         'max_bytes_in_flight': config.get('settings').get('max_bytes_in_flight')}
+        if backend == 'asyncio':
+            imap_pool[acc_id] = AsyncIMAP(**imap_settings)
+        else:
+            imap_pool[acc_id] = IMAP(pipeline_depth=config.get('settings').get('pipeline_depth', 8),
+                                     fetch_connections=config.get('settings').get('fetch_connections', 1),
+                                     message_id_index_size=config.get('settings').get('message_id_index_size', 10000),
+                                     **imap_settings)
+
+        # Reconnects broken connections, failures of one account don't affect the others
+        managers[acc_id] = ConnectionManager(logger=acc_loggers[acc_id],
+                                             imap=imap_pool[acc_id],
+                                             backoff=config.get('settings').get('reconnect_backoff', 2),
+                                             backoff_max=config.get('settings').get('reconnect_backoff_max', 300),
+                                             keepalive_interval=config.get('settings').get('keepalive_interval', 300))
+        if backend == 'asyncio':
+            # Connecting happens within the event loop
+            continue
+
+        connect = managers[acc_id].connect()
         if not connect.code:
             logger.error('%s: Failed to login, please check your account credentials: %s', acc_settings.get('username'), connect.data)
-            exit(127)
         else:
             logger.info('%s: Sucessfully logged in!', acc_settings.get('username'))
 
+    # Compile the filters once, instead of for each mail, and remember their decisions for recurring senders
+    programs = {}
+    decision_cache_size = config.get('settings').get('decision_cache_size', 10000)
+    for acc_id in config.get('accounts'):
+        programs[acc_id] = FilterProgram(config.get('filters').get(acc_id), cache=DecisionCache(decision_cache_size) if decision_cache_size else None)
+
+    # Only fetch the mail headers the filters are actually looking at
+    fetch_headers = {}
+    for acc_id in config.get('accounts'):
+        fetch_headers[acc_id] = MailFilter.get_header_names(config.get('filters').get(acc_id, {}))
+        if fetch_headers[acc_id] is None:
+            logger.debug('%s: Fetching whole mails, a filter command needs more than headers', acc_id)
+        else:
+            logger.debug('%s: Fetching mail headers %s', acc_id, fetch_headers[acc_id])
+
+    # Remember which mails were processed already, so that each cycle only looks at new mails
+    checkpoint = Checkpoint(logger=logger, path=config.get('settings').get('checkpoint_file'), readonly=bool(test))
+    checkpoint.load()
+
+    idle = config.get('settings').get('idle', False)
+    idle_timeout = config.get('settings').get('idle_timeout', 1680)
+
+    if backend == 'asyncio':
+        logger.info('Entering mail-sorting loop (asyncio)')
+        try:
+            return asyncio.run(sort_accounts_async(logger=logger,
+                                                   managers=managers,
+                                                   config=config,
+                                                   programs=programs,
+                                                   fetch_headers=fetch_headers,
+                                                   checkpoint=checkpoint,
+                                                   idle=idle,
+                                                   idle_timeout=idle_timeout,
+                                                   sleep_time=imap_sleep_time))
+        except Exception as e:
+            trace_info = exc_info()
+            logger.error('Catching unknown exception: %s. Showing stack trace and going to die..', e)
+
+            print_exception(*trace_info)
+            del trace_info
+
+            exit(1)
+
+    # Accounts are sorted concurrently, each one using its own IMAP connection
+    workers = config.get('settings').get('workers', 1)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    logger.debug('Processing up to %s accounts at once', workers)
+
     logger.info('Entering mail-sorting loop')
+    acc_ids = sorted(config.get('accounts'))
+    next_poll = None
+    # Accounts in IDLE mode and when it was started, IDLE keeps running until an account is woken up
+    idling = {}
+    # Running cycles, an account that takes longer than cycle_timeout is left running while the others continue
+    futures = {}
+    cycle_timeout = config.get('settings').get('cycle_timeout', 900)
     while True:
-        for acc_id, acc_settings in sorted(config.get('accounts').items()):
-            pre_inbox = acc_settings.get('pre_inbox', 'PreInbox')
-            pre_inbox_search = acc_settings.get('pre_inbox_search', 'ALL')
-            sort_mailbox = acc_settings.get('sort_mailbox', None)
-
-            try:
-                if not imap_pool[acc_id].mailbox_exists(pre_inbox).data:
-                    imap_pool[acc_id].logger.info('%s: Destination mailbox %s doesn\'t exist, creating it for you',
-                                                  acc_settings.get('username'), pre_inbox)
-
-                    result = imap_pool[acc_id].create_mailbox(mailbox=pre_inbox)
-                    if not result.code:
-                        imap_pool[acc_id].logger.error('%s: Failed to create the mailbox %s: %s', acc_settings.get('username'), pre_inbox,
-                                                       result.data)
-                        return result
-
-                mail_uids = imap_pool[acc_id].search_mails(mailbox=pre_inbox, criteria=pre_inbox_search, autocreate_mailbox=True).data
-                if not mail_uids:
-                    logger.debug('%s: No mails found to sort', acc_settings.get('username'))
+        submitted = []
+        for acc_id in acc_ids:
+            if acc_id in futures:
+                continue
+            futures[acc_id] = executor.submit(managers[acc_id].run,
+                                              sort_mails,
+                                              logger=acc_loggers[acc_id],
+                                              acc_id=acc_id,
+                                              acc_settings=config.get('accounts').get(acc_id),
+                                              program=programs[acc_id],
+                                              fetch_headers=fetch_headers[acc_id],
+                                              checkpoint=checkpoint)
+            submitted.append(futures[acc_id])
+
+        wait(submitted, timeout=cycle_timeout)
+        failed = set()
+        for acc_id in sorted(futures):
+            if not futures[acc_id].done():
+                logger.error('%s: Sorting mails takes longer than %s seconds, continuing with the other accounts',
+                             config.get('accounts').get(acc_id).get('username'), cycle_timeout)
+                failed.add(acc_id)
+                continue
+
+            result = futures.pop(acc_id).result()
+            if not result.code:
+                logger.error('%s: Failed to sort mails: %s', config.get('accounts').get(acc_id).get('username'), result.data)
+                failed.add(acc_id)
+
+        if idle:
+            if next_poll is None or time() >= next_poll:
+                next_poll = time() + imap_sleep_time
+
+            logger.debug('All accounts checked, waiting for new mails..')
+            acc_ids = wait_for_mails(logger=logger,
+                                     managers=managers,
+                                     accounts=config.get('accounts'),
+                                     checkpoint=checkpoint,
+                                     idling=idling,
+                                     failed=failed,
+                                     busy=set(futures),
+                                     poll_deadline=next_poll,
+                                     idle_timeout=idle_timeout)
+        else:
+            logger.debug('All accounts checked, going to sleep for %s seconds before checking again..', imap_sleep_time)
+            sleep_with_keepalives([managers[acc_id] for acc_id in acc_ids if acc_id not in futures], imap_sleep_time)
+
+
+def sort_mails(logger, imap, acc_id, acc_settings, program, fetch_headers, checkpoint):
+    """
+    Sort new mails of an account's PreInbox
+    """
+    pre_inbox = acc_settings.get('pre_inbox', 'PreInbox')
+
+    if not imap.mailbox_exists(pre_inbox).data:
+        imap.logger.info('%s: Destination mailbox %s doesn\'t exist, creating it for you', acc_settings.get('username'), pre_inbox)
+
+        result = imap.create_mailbox(mailbox=pre_inbox)
+        if not result.code:
+            imap.logger.error('%s: Failed to create the mailbox %s: %s', acc_settings.get('username'), pre_inbox, result.data)
+            return result
+
+    # Mails moved by an aborted cycle are still in the PreInbox, flagged as deleted
+    result = imap.flush_expunges()
+    if not result.code:
+        return result
+
+    # Select the mailbox again to get a fresh HIGHESTMODSEQ
+    status = imap.select_mailbox(pre_inbox, force=True).data
+    criteria, last_uid = get_search_criteria(logger, acc_id, acc_settings, status, checkpoint)
+    if criteria is None:
+        return IMAP.Retval(True, None)
+
+    mail_uids = imap.search_mails(mailbox=pre_inbox, criteria=criteria, autocreate_mailbox=True, min_uid=last_uid + 1).data
+    if mail_uids:
+        # Only a limited number of mails is held in memory, their actions are applied batch by batch
+        for result in imap.stream_mails(uids=mail_uids, mailbox=pre_inbox, headers=fetch_headers):
+            if not result.code:
+                raise RuntimeError('Failed to fetch mails from {}: {}'.format(pre_inbox, result.data))
+            execute_plan(imap, plan_mails(logger, imap, acc_settings, program, result.data))
+        if program.cache is not None:
+            logger.debug('%s: Decision cache: %s hit(s), %s miss(es)', acc_settings.get('username'), program.cache.hits, program.cache.misses)
+
+        result = imap.flush_expunges()
+        if not result.code:
+            raise RuntimeError('Failed to expunge moved mails: {}'.format(result.data))
+
+    return update_checkpoint(logger, acc_id, acc_settings, status, checkpoint, last_uid, mail_uids)
+
+
+async def sort_mails_async(logger, imap, acc_id, acc_settings, program, fetch_headers, checkpoint):
+    """
+    Sort new mails of an account's PreInbox using the asyncio IMAP backend
+    """
+    pre_inbox = acc_settings.get('pre_inbox', 'PreInbox')
+
+    if not (await imap.mailbox_exists(pre_inbox)).data:
+        imap.logger.info('%s: Destination mailbox %s doesn\'t exist, creating it for you', acc_settings.get('username'), pre_inbox)
+
+        result = await imap.create_mailbox(mailbox=pre_inbox)
+        if not result.code:
+            imap.logger.error('%s: Failed to create the mailbox %s: %s', acc_settings.get('username'), pre_inbox, result.data)
+            return result
+
+    result = await imap.flush_expunges()
+    if not result.code:
+        return result
+
+    status = (await imap.select_mailbox(pre_inbox, force=True)).data
+    criteria, last_uid = get_search_criteria(logger, acc_id, acc_settings, status, checkpoint)
+    if criteria is None:
+        return IMAP.Retval(True, None)
+
+    mail_uids = (await imap.search_mails(mailbox=pre_inbox, criteria=criteria, min_uid=last_uid + 1)).data
+    if mail_uids:
+        async for result in imap.stream_mails(uids=mail_uids, mailbox=pre_inbox, headers=fetch_headers):
+            if not result.code:
+                raise RuntimeError('Failed to fetch mails from {}: {}'.format(pre_inbox, result.data))
+            await execute_plan_async(imap, plan_mails(logger, imap, acc_settings, program, result.data))
+        if program.cache is not None:
+            logger.debug('%s: Decision cache: %s hit(s), %s miss(es)', acc_settings.get('username'), program.cache.hits, program.cache.misses)
+
+        result = await imap.flush_expunges()
+        if not result.code:
+            raise RuntimeError('Failed to expunge moved mails: {}'.format(result.data))
+
+    return update_checkpoint(logger, acc_id, acc_settings, status, checkpoint, last_uid, mail_uids)
+
+
+def get_search_criteria(logger, acc_id, acc_settings, status, checkpoint):
+    """
+    Return the search criteria for new mails of an account's PreInbox (or None if nothing changed) and the highest UID processed already
+
+    Only new UIDs are looked at, flag changes of mails that were processed already don't make them be sorted again. CONDSTORE
+    just tells when nothing can have changed, so that the search can be skipped.
+    """
+    pre_inbox = acc_settings.get('pre_inbox', 'PreInbox')
+    highestmodseq = status.get('HIGHESTMODSEQ')
+    last_uid = checkpoint.get(acc_id, pre_inbox, status.get('UIDVALIDITY'))
+    last_highestmodseq = checkpoint.get_highestmodseq(acc_id, pre_inbox)
+
+    # With CONDSTORE, nothing can have changed as long as the mailbox' HIGHESTMODSEQ stays the same
+    if highestmodseq is not None and highestmodseq == last_highestmodseq:
+        logger.debug('%s: Mailbox %s didn\'t change since the last check (HIGHESTMODSEQ=%s)', acc_settings.get('username'), pre_inbox, highestmodseq)
+        return None, last_uid
+
+    # Mails flagged as deleted were moved already but not expunged yet (see the end_of_cycle and uid_only expunge policies),
+    # unless the configured search cares about the \Deleted flag itself
+    criteria = acc_settings.get('pre_inbox_search', 'ALL')
+    if not regex_compile(r'\b(UN)?DELETED\b', IGNORECASE).search(criteria):
+        criteria = 'UNDELETED {}'.format(criteria)
+    return criteria, last_uid
+
+
+def plan_mails(logger, imap, acc_settings, program, mails):
+    """
+    Run the filters (a FilterProgram) on mails and return the resulting actions
+    """
+    sort_mailbox = acc_settings.get('sort_mailbox', None)
+    plan = ActionPlan(logger=logger, mailbox=acc_settings.get('pre_inbox', 'PreInbox'))
+    for uid, mail in mails.items():
+        match = False
+
+        if mail.get_message_id() is None:
+            # Leave the mail in the PreInbox instead of aborting, this may run in a worker thread shared with other accounts
+            logger.error('%s: Mail with uid=%s and subject=\'%s\' doesn\'t have a message-id, skipping it', acc_settings.get('username'), uid,
+                         mail.get_header('subject'))
+            continue
+
+        compiled = program.first_match(mail)
+        if compiled is not None:
+            match = True
+            MailFilter(logger=logger, imap=imap, mail=mail, config=compiled.config, mailbox=plan.mailbox, plan=plan, compiled=compiled).process_match()
+
+        if match:
+            continue
+
+        if sort_mailbox:
+            logger.info('%s: Moving mail with uid=%s that did not match any filter to %s', acc_settings.get('username'), uid, sort_mailbox)
+            plan.move(uid=uid, destination=sort_mailbox, set_flags=[])
+        else:
+            plan.set_flags(uid=uid, flags=acc_settings.get('unmatched_mail_flags', ['\\FLAGGED']))
+    return plan
+
+
+def execute_plan(imap, plan):
+    """
+    Apply the actions of a plan
+    """
+    result = plan.execute(imap)
+    if not result.code:
+        raise RuntimeError('Failed to apply the actions for mails in {}: {}'.format(plan.mailbox, result.data))
+    return result
+
+
+async def execute_plan_async(imap, plan):
+    """
+    Apply the actions of a plan using the asyncio IMAP backend
+    """
+    result = await plan.execute_async(imap)
+    if not result.code:
+        raise RuntimeError('Failed to apply the actions for mails in {}: {}'.format(plan.mailbox, result.data))
+    return result
+
+
+def update_checkpoint(logger, acc_id, acc_settings, status, checkpoint, last_uid, mail_uids):
+    """
+    Remember the highest processed UID and HIGHESTMODSEQ of an account's PreInbox
+    """
+    if not mail_uids:
+        logger.debug('%s: No mails found to sort', acc_settings.get('username'))
+    else:
+        last_uid = max(mail_uids)
+
+    checkpoint.set(acc_id, acc_settings.get('pre_inbox', 'PreInbox'), status.get('UIDVALIDITY'), last_uid, status.get('HIGHESTMODSEQ'), status.get('UIDNEXT'))
+    checkpoint.save()
+    return IMAP.Retval(True, mail_uids or None)
+
+
+def has_new_mails(acc_id, acc_settings, status, checkpoint):
+    """
+    Return whether mails arrived in an account's PreInbox since the start of its last cycle, judging by its UIDNEXT
+
+    EXISTS responses for mails that arrive while sorting are mixed into the responses of the cycle and never seen by IDLE.
+    """
+    uidnext = checkpoint.get_uidnext(acc_id, acc_settings.get('pre_inbox', 'PreInbox'))
+    return uidnext is not None and status.get('UIDNEXT') is not None and status.get('UIDNEXT') != uidnext
+
+
+async def sort_accounts_async(logger, managers, config, programs, fetch_headers, checkpoint, idle, idle_timeout, sleep_time):
+    """
+    Connect to and sort the mails of all accounts within a single event loop, each account waiting for new mails on its own
+    """
+    async def sort_account(acc_id):
+        manager = managers[acc_id]
+        acc_settings = config.get('accounts').get(acc_id)
+        while True:
+            result = await manager.run_async(sort_mails_async,
+                                             logger=manager.logger,
+                                             acc_id=acc_id,
+                                             acc_settings=acc_settings,
+                                             program=programs[acc_id],
+                                             fetch_headers=fetch_headers[acc_id],
+                                             checkpoint=checkpoint)
+            if not result.code:
+                logger.error('%s: Failed to sort mails: %s', acc_settings.get('username'), result.data)
+                await manager.sleep_async(max(manager.next_attempt - time(), sleep_time))
+                continue
+
+            if idle and manager.imap.has_capability(Feature.IDLE):
+                status = await manager.imap.select_mailbox(acc_settings.get('pre_inbox', 'PreInbox'), force=True)
+                if status.code and has_new_mails(acc_id, acc_settings, status.data, checkpoint):
+                    manager.logger.debug('New mails arrived while sorting, sorting again')
                     continue
 
-                mails = imap_pool[acc_id].fetch_mails(uids=mail_uids, mailbox=pre_inbox).data
-                mails_without_match = []
-                for uid, mail in mails.items():
-                    match = False
-
-                    if mail.get_message_id() is None:
-                        logger.error('Mail with uid={} and subject=\'{}\' doesn\'t have a message-id! Abort..'.format(
-                            uid, mail.get_header('subject')))
-                        exit(1)
-
-                    for filter_name, filter_settings in Helper().sort_dict(config.get('filters').get(acc_id)).items():
-                        mail_filter = MailFilter(logger=logger,
-                                                 imap=imap_pool[acc_id],
-                                                 mail=mail,
-                                                 config=filter_settings,
-                                                 mailbox=pre_inbox)
-                        match = mail_filter.check_rules_match()
-                        if match:
-                            break
-
-                    if match:
-                        continue
-
-                    if sort_mailbox:
-                        mails_without_match.append(uid)
-                    else:
-                        imap_pool[acc_id].set_mailflags(uids=[uid],
-                                                        mailbox=pre_inbox,
-                                                        flags=acc_settings.get('unmatched_mail_flags', ['\\FLAGGED']))
-
-                if sort_mailbox and mails_without_match:
-                    logger.info('%s: Moving mails that did not match any filter to %s', acc_settings.get('username'), sort_mailbox)
-
-                    for uid in mails_without_match:
-                        mail = mails[uid]
-                        imap_pool[acc_id].move_mail(message_ids=[mail.get_message_id()],
-                                                    source=pre_inbox,
-                                                    destination=sort_mailbox,
-                                                    set_flags=[])
-
-            # except IMAPClient.Error as e:
-            #    logger.error('%s: Catching exception: %s. This is bad and I am sad. Going to sleep for a few seconds and trying again..',
-            #                 acc_settings.get('username'), e)
-            #    sleep(10)
-
-            except Exception as e:
-                trace_info = exc_info()
-                logger.error('%s: Catching unknown exception: %s. Showing stack trace and going to die..', acc_settings.get('username'), e)
-
-                print_exception(*trace_info)
-                del trace_info
-
-                exit(1)
-
-        logger.debug('All accounts checked, going to sleep for %s seconds before checking again..', imap_sleep_time)
-        sleep(imap_sleep_time)
+                # IDLE is re-issued before keepalive_interval expires, so that the connection doesn't look unused
+                result = await manager.imap.idle(mailbox=acc_settings.get('pre_inbox', 'PreInbox'), timeout=manager.get_idle_timeout(idle_timeout))
+                if result.code:
+                    manager.last_activity = time()
+                    continue
+                manager.record_failure(result.data)
+            await manager.sleep_async(sleep_time)
+
+    await asyncio.gather(*[sort_account(acc_id) for acc_id in sorted(config.get('accounts'))])
+
+
+def sleep_with_keepalives(managers, seconds):
+    """
+    Sleep for the given number of seconds, sending keepalives to the connections of the given ConnectionManagers in the meantime
+    """
+    deadline = time() + seconds
+    while True:
+        for manager in managers:
+            manager.keepalive()
+        now = time()
+        if now >= deadline:
+            return
+        wakeup = min([deadline] + [manager.next_keepalive() for manager in managers if manager.next_keepalive() is not None])
+        sleep(max(wakeup - now, 0))
+
+
+def wait_for_mails(logger, managers, accounts, checkpoint, idling, poll_deadline, idle_timeout, failed=(), busy=()):
+    """
+    Wait until new mails arrive in the PreInbox of an account and return the ids of accounts to check again
+
+    Accounts whose server supports IDLE are woken up as soon as the server reports EXISTS/RECENT, all others (including
+    disconnected ones and those whose last cycle failed) are polled once poll_deadline has passed and get keepalives in the
+    meantime. idling maps the ids of accounts in IDLE mode to the time it was started and is kept across calls: IDLE is only
+    stopped for accounts that are woken up and re-issued after idle_timeout seconds (or keepalive_interval if shorter) to stay
+    below the 29 minutes limit of RFC 2177. The connections of busy accounts (whose cycle is still running) are not touched.
+    """
+    woken = set()
+    polling = []
+    for acc_id, acc_settings in sorted(accounts.items()):
+        if acc_id in idling:
+            continue
+
+        imap = managers[acc_id].imap
+        pre_inbox = acc_settings.get('pre_inbox', 'PreInbox')
+        if acc_id in failed or not managers[acc_id].connected or not imap.has_capability(Feature.IDLE):
+            polling.append(acc_id)
+            continue
+
+        status = imap.select_mailbox(pre_inbox, force=True)
+        if status.code and has_new_mails(acc_id, acc_settings, status.data, checkpoint):
+            logger.debug('%s: New mails arrived while sorting, sorting again', acc_id)
+            woken.add(acc_id)
+        elif status.code and imap.idle_start(mailbox=pre_inbox).code:
+            idling[acc_id] = managers[acc_id].last_activity = time()
+        else:
+            polling.append(acc_id)
+
+    if not polling:
+        poll_deadline = None
+    keepalives = [managers[acc_id] for acc_id in polling if acc_id not in busy]
+
+    while not woken:
+        for manager in keepalives:
+            manager.keepalive()
+
+        # Renew IDLE before the server or a NAT device drops the connection
+        for acc_id in [acc_id for acc_id, started in idling.items() if time() - started >= managers[acc_id].get_idle_timeout(idle_timeout)]:
+            imap = managers[acc_id].imap
+            result = imap.idle_done()
+            if result.code and not has_exists_response(result.data[1]):
+                result = imap.idle_start(mailbox=accounts.get(acc_id).get('pre_inbox', 'PreInbox'))
+                if result.code:
+                    idling[acc_id] = managers[acc_id].last_activity = time()
+                    continue
+            if not result.code:
+                managers[acc_id].record_failure(result.data)
+            del idling[acc_id]
+            woken.add(acc_id)
+        if woken:
+            break
+
+        deadlines = [started + managers[acc_id].get_idle_timeout(idle_timeout) for acc_id, started in idling.items()]
+        if poll_deadline is not None:
+            deadlines.append(poll_deadline)
+        if not deadlines or (poll_deadline is not None and time() >= poll_deadline):
+            break
+        deadlines.extend(manager.next_keepalive() for manager in keepalives if manager.next_keepalive() is not None)
+
+        timeout = max(min(deadlines) - time(), 0)
+        if not idling:
+            sleep(timeout)
+            continue
+
+        sockets = dict((managers[acc_id].imap.socket(), acc_id) for acc_id in idling)
+        readable, _, _ = select(list(sockets.keys()), [], [], timeout)
+        for sock in readable:
+            acc_id = sockets[sock]
+            result = managers[acc_id].imap.idle_check(timeout=0)
+            if not result.code:
+                # The connection broke, let the next cycle reconnect
+                managers[acc_id].record_failure(result.data)
+                del idling[acc_id]
+                woken.add(acc_id)
+            elif has_exists_response(result.data):
+                logger.debug('%s: Woken up by the server, new mails have arrived', acc_id)
+                woken.add(acc_id)
+
+    # Only the accounts that are going to be sorted leave IDLE mode
+    for acc_id in sorted(woken):
+        if acc_id in idling:
+            del idling[acc_id]
+            if not managers[acc_id].imap.idle_done().code:
+                managers[acc_id].record_failure('Failed to stop IDLE')
+
+    if poll_deadline is not None and time() >= poll_deadline:
+        woken.update(polling)
+    return sorted(woken)
+
+
+def has_exists_response(responses):
+    """
+    Return whether IDLE responses tell about new mails (EXISTS/RECENT)
+    """
+    return any(len(response) > 1 and response[1] in (b'EXISTS', b'RECENT') for response in responses)
 
 
 if __name__ == '__main__':
@@ -102,6 +102,61 @@ class Helper:
         """
         return text.encode(encoding)
 
+    @staticmethod
+    def chunks(items, size):
+        """
+        Split a list into lists of at most size items
+        """
+        items = list(items)
+        for index in range(0, len(items), size):
+            yield items[index:index + size]
+
+    @staticmethod
+    def batches(items, max_items=None, sizes=None, max_size=None):
+        """
+        Split a list into lists of at most max_items items whose sizes add up to at most max_size (single items may exceed it)
+        """
+        batch = []
+        batch_size = 0
+        for item in items:
+            size = sizes.get(item, 0) if sizes else 0
+            if batch and ((max_items and len(batch) >= max_items) or (max_size and batch_size + size > max_size)):
+                yield batch
+                batch = []
+                batch_size = 0
+            batch.append(item)
+            batch_size += size
+        if batch:
+            yield batch
+
+    @staticmethod
+    def uids_to_sequence_set(uids):
+        """
+        Convert a list of UIDs to a compact IMAP sequence set (e.g. 1:500,502,510:800)
+        """
+        ranges = []
+        for uid in sorted(set(uids)):
+            if ranges and uid == ranges[-1][1] + 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+
+        return ','.join(str(first) if first == last else '{}:{}'.format(first, last) for first, last in ranges)
+
+    @staticmethod
+    def sequence_set_to_uids(sequence_set):
+        """
+        Convert an IMAP sequence set (e.g. 1:3,5) to a list of UIDs
+        """
+        uids = []
+        for part in Helper().byte_to_str(sequence_set).split(','):
+            if ':' in part:
+                first, last = sorted(int(uid) for uid in part.split(':'))
+                uids.extend(range(first, last + 1))
+            elif part:
+                uids.append(int(part))
+        return uids
+
     @staticmethod
     def merge_dict(a, b, path=None):
         """"
@@ -125,6 +180,16 @@ class Helper:
         return a
 
 
+class AccountLoggerAdapter(logging.LoggerAdapter):
+    """
+    Logger adapter that prefixes messages with the account they belong to, accounts may be processed concurrently
+    """
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = self.extra
+        return '[{}] {}'.format(self.extra['account'], msg), kwargs
+
+
 class CaseInsensitiveDict(dict):
     """
     Basic case insensitive dict with strings only keys.
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from tabellarius.action_plan import ActionPlan
+
+from .tabellarius_test import TabellariusTest
+
+
+class ActionPlanTest(TabellariusTest):
+    def test_grouping(self):
+        plan = ActionPlan(logger=self.logger, mailbox='INBOX')
+
+        plan.move(uid=1, destination='Trash', set_flags=[])
+        plan.move(uid=2, destination='Trash', set_flags=[])
+        plan.move(message_id='<3@example.com>', destination='Trash', set_flags=[])
+        plan.move(uid=4, destination='Trash', add_flags='\\Flagged')
+        plan.move(uid=7, message_id='<7@example.com>', destination='Shops', add_flags=['\\Flagged'])
+        plan.set_flags(uid=5, flags=['\\Flagged'])
+        plan.set_flags(uid=6, flags=['\\Flagged'])
+
+        self.assertEqual(len(plan), 7)
+        self.assertEqual(list(plan.moves.items()), [(('Trash', None, ()), {'uids': [1, 2], 'message_ids': ['<3@example.com>']}),
+                                                    (('Trash', ('\\Flagged',), None), {'uids': [4], 'message_ids': []}),
+                                                    (('Shops', ('\\Flagged',), None), {'uids': [7], 'message_ids': []})])
+        self.assertEqual(plan.flags, {('\\Flagged',): [5, 6]})
+
+    def test_execute(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        plan = ActionPlan(logger=self.logger, mailbox='INBOX')
+        for uid in range(1, 5):
+            mail = self.create_email(headers={'Message-Id': '<plan_{0}_{1}@example.com>'.format(uid, username)})
+            self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=mail), (True, uid))
+            if uid < 3:
+                plan.move(uid=uid, destination='Sorted', add_flags=['\\Flagged'])
+            elif uid < 4:
+                plan.move(message_id=mail.get_message_id(), destination='Sorted', add_flags=['\\Flagged'])
+            else:
+                plan.set_flags(uid=uid, flags=['\\Seen'])
+
+        self.assertEqual(plan.execute(imapconn), (True, {'Sorted': [1, 2, 3]}))
+        self.assertEqual(len(plan), 0)
+
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX'), (True, [4]))
+        self.assertEqual(imapconn.get_mailflags(uids=[4], mailbox='INBOX'), (True, {4: ['\\Seen']}))
+        self.assertIn('\\Flagged', imapconn.get_mailflags(uids=[1], mailbox='Sorted').data[1])
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+import asyncio
+
+from tabellarius.action_plan import ActionPlan
+from tabellarius.aioimap import AsyncIMAP
+
+from .tabellarius_test import TabellariusTest
+
+
+class AsyncIMAPTest(TabellariusTest):
+    def create_async_imap_object(self, username, password):
+        return AsyncIMAP(logger=self.logger,
+                         server=self.INTEGRATION_ADDR_IMAPSERVER,
+                         port=self.INTEGRATION_PORT_IMAPS,
+                         imaps=True,
+                         tlsverify=False,
+                         username=username,
+                         password=password,
+                         timeout=5)
+
+    def test_connect(self):
+        username, password = self.create_imap_user()
+
+        async def run():
+            imapconn = self.create_async_imap_object(username, password)
+            self.assertEqual(await imapconn.connect(), (True, 'Logged in'))
+            self.assertTrue(imapconn.has_capability('IDLE'))
+            self.assertEqual(await imapconn.mailbox_exists('INBOX'), (True, True))
+            self.assertEqual((await imapconn.disconnect()).code, True)
+
+            imapconn = self.create_async_imap_object(username, 'wrong password')
+            self.assertFalse((await imapconn.connect()).code)
+
+            imapconn = self.create_async_imap_object(username, password)
+            imapconn.starttls = True
+            self.assertFalse((await imapconn.connect()).code)
+
+        asyncio.run(run())
+
+    def test_sort_mails(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+        for uid in range(1, 4):
+            self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, uid))
+
+        async def run():
+            aimapconn = self.create_async_imap_object(username, password)
+            self.assertEqual(await aimapconn.connect(), (True, 'Logged in'))
+
+            self.assertEqual(await aimapconn.search_mails(mailbox='INBOX'), (True, [1, 2, 3]))
+            self.assertEqual(await aimapconn.search_mails(mailbox='INBOX', min_uid=3), (True, [3]))
+
+            mails = (await aimapconn.fetch_mails(uids=[1, 2, 1337], mailbox='INBOX', headers=['subject'])).data
+            self.assertEqual(sorted(mails.keys()), [1, 2])
+            self.assertEqual(mails[1].get_header('Subject'), 'Testmäil')
+            self.assertEqual(mails[1].uid, 1)
+
+            plan = ActionPlan(logger=self.logger, mailbox='INBOX')
+            plan.move(uid=1, destination='Sorted', add_flags=['\\Flagged'])
+            plan.move(uid=2, destination='Sorted', add_flags=['\\Flagged'])
+            plan.set_flags(uid=3, flags=['\\Seen'])
+            self.assertEqual(await plan.execute_async(aimapconn), (True, {'Sorted': [1, 2]}))
+
+            # Nothing happens within the timeout
+            self.assertEqual(await aimapconn.idle(mailbox='INBOX', timeout=1), (True, False))
+
+            self.assertEqual((await aimapconn.disconnect()).code, True)
+
+        asyncio.run(run())
+
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX'), (True, [3]))
+        self.assertEqual(imapconn.get_mailflags(uids=[3], mailbox='INBOX'), (True, {3: ['\\Seen']}))
+        self.assertIn('\\Flagged', imapconn.get_mailflags(uids=[1], mailbox='Sorted').data[1])
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
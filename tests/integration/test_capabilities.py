@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from tabellarius.capabilities import Capabilities, Feature
+
+from .tabellarius_test import TabellariusTest
+
+
+class CapabilitiesTest(TabellariusTest):
+    def test_features(self):
+        capabilities = Capabilities([b'IMAP4REV1', b'IDLE', b'MOVE', b'qresync', b'LITERAL+', b'COMPRESS=DEFLATE', b'SORT'])
+
+        self.assertEqual(capabilities.features, frozenset([Feature.IDLE, Feature.MOVE, Feature.QRESYNC, Feature.CONDSTORE,
+                                                           Feature.LITERAL_PLUS, Feature.COMPRESS]))
+        self.assertIn(Feature.CONDSTORE, capabilities)
+        self.assertNotIn(Feature.UIDPLUS, capabilities)
+        self.assertIn('SORT', capabilities)
+        self.assertIn(b'sort', capabilities)
+        self.assertNotIn('THREAD=REFERENCES', capabilities)
+        self.assertEqual(str(capabilities), 'COMPRESS, CONDSTORE, IDLE, LITERAL_PLUS, MOVE, QRESYNC')
+
+        self.assertNotIn(Feature.IDLE, Capabilities())
+        self.assertEqual(str(Capabilities()), 'none')
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+import os
+import tempfile
+
+from tabellarius.checkpoint import Checkpoint
+
+from .tabellarius_test import TabellariusTest
+
+
+class CheckpointTest(TabellariusTest):
+    def test_get_and_set(self):
+        checkpoint = Checkpoint(logger=self.logger)
+
+        self.assertEqual(checkpoint.get('test', 'PreInbox', 42), 0)
+        checkpoint.set('test', 'PreInbox', 42, 1337)
+        self.assertEqual(checkpoint.get('test', 'PreInbox', 42), 1337)
+        self.assertEqual(checkpoint.get('test', 'INBOX', 42), 0)
+        self.assertEqual(checkpoint.get('other', 'PreInbox', 42), 0)
+        self.assertFalse(checkpoint.save())
+
+    def test_uidvalidity_change(self):
+        checkpoint = Checkpoint(logger=self.logger)
+
+        checkpoint.set('test', 'PreInbox', 42, 1337)
+        self.assertEqual(checkpoint.get('test', 'PreInbox', 43), 0)
+        self.assertEqual(checkpoint.get('test', 'PreInbox', 42), 0)
+
+    def test_highestmodseq(self):
+        checkpoint = Checkpoint(logger=self.logger)
+
+        self.assertIsNone(checkpoint.get_highestmodseq('test', 'PreInbox'))
+        checkpoint.set('test', 'PreInbox', 42, 1337)
+        self.assertIsNone(checkpoint.get_highestmodseq('test', 'PreInbox'))
+        checkpoint.set('test', 'PreInbox', 42, 1337, 23)
+        self.assertEqual(checkpoint.get_highestmodseq('test', 'PreInbox'), 23)
+
+    def test_uidnext(self):
+        checkpoint = Checkpoint(logger=self.logger)
+
+        self.assertIsNone(checkpoint.get_uidnext('test', 'PreInbox'))
+        checkpoint.set('test', 'PreInbox', 42, 1337, 23, 1338)
+        self.assertEqual(checkpoint.get_uidnext('test', 'PreInbox'), 1338)
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'checkpoints.json')
+
+            checkpoint = Checkpoint(logger=self.logger, path=path)
+            self.assertEqual(checkpoint.load(), {})
+            checkpoint.set('test', 'PreInbox', 42, 1337)
+            self.assertTrue(checkpoint.save())
+            self.assertFalse(checkpoint.save())
+
+            checkpoint = Checkpoint(logger=self.logger, path=path)
+            checkpoint.load()
+            self.assertEqual(checkpoint.get('test', 'PreInbox', 42), 1337)
+
+            with open(path, 'w') as stream:
+                stream.write('{broken')
+            self.assertEqual(Checkpoint(logger=self.logger, path=path).load(), {})
+
+    def test_readonly(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'checkpoints.json')
+
+            checkpoint = Checkpoint(logger=self.logger, path=path)
+            checkpoint.set('test', 'PreInbox', 42, 1337)
+            self.assertTrue(checkpoint.save())
+
+            # Progress of a dry run is kept in memory only
+            checkpoint = Checkpoint(logger=self.logger, path=path, readonly=True)
+            checkpoint.load()
+            checkpoint.set('test', 'PreInbox', 42, 2000)
+            self.assertEqual(checkpoint.get('test', 'PreInbox', 42), 2000)
+            self.assertFalse(checkpoint.save())
+
+            checkpoint = Checkpoint(logger=self.logger, path=path)
+            checkpoint.load()
+            self.assertEqual(checkpoint.get('test', 'PreInbox', 42), 1337)
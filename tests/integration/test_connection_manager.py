@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+import time
+
+from tabellarius.connection_manager import ConnectionManager
+
+from .tabellarius_test import TabellariusTest
+
+
+class ConnectionManagerTest(TabellariusTest):
+    def test_backoff(self):
+        manager = ConnectionManager(logger=self.logger, imap=None, backoff=2, backoff_max=10)
+        self.assertFalse(manager.waiting())
+
+        for failures, delay in [(1, 2), (2, 4), (3, 8), (4, 10), (10, 10)]:
+            manager.failures = failures
+            for _ in range(10):
+                self.assertTrue(delay / 2 <= manager.get_backoff() <= delay)
+
+        manager.failures = 0
+        manager.record_failure('Connection reset by peer')
+        self.assertEqual(manager.failures, 1)
+        self.assertFalse(manager.connected)
+        self.assertTrue(manager.waiting())
+        self.assertFalse(manager.run(lambda imap: None).code)
+
+        manager.record_success()
+        self.assertEqual(manager.failures, 0)
+        self.assertTrue(manager.connected)
+        self.assertFalse(manager.waiting())
+        self.assertFalse(manager.keepalive_due())
+        manager.last_activity = time.time() - 300
+        self.assertTrue(manager.keepalive_due())
+        self.assertEqual(manager.next_keepalive(), manager.last_activity + 300)
+
+        # IDLE is re-issued before the keepalive interval expires
+        self.assertEqual(manager.get_idle_timeout(1680), 300)
+        self.assertEqual(manager.get_idle_timeout(60), 60)
+        manager.keepalive_interval = 0
+        self.assertIsNone(manager.next_keepalive())
+        self.assertEqual(manager.get_idle_timeout(1680), 1680)
+
+    def test_reconnect(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        manager = ConnectionManager(logger=self.logger, imap=imapconn, backoff=0)
+
+        self.assertEqual(manager.connect(), (True, 'Logged in'))
+        self.assertEqual(imapconn.select_mailbox('INBOX', readonly=True).code, True)
+
+        def fail(imap):
+            imap.conn.shutdown()
+            raise OSError('Connection reset by peer')
+
+        # Exceptions that didn't break the connection don't cause a reconnect
+        def bug(imap):
+            raise ValueError('Unexpected response')
+
+        self.assertEqual(manager.run(bug), (False, 'Unexpected response'))
+        self.assertTrue(manager.connected)
+        self.assertEqual(manager.failures, 0)
+
+        self.assertFalse(manager.run(fail).code)
+        self.assertFalse(manager.connected)
+        self.assertEqual(manager.failures, 1)
+
+        # The connection and the selected mailbox are restored on the next run
+        self.assertEqual(manager.run(lambda imap: imap.search_mails(mailbox='INBOX')), (True, []))
+        self.assertTrue(manager.connected)
+        self.assertEqual(manager.failures, 0)
+        self.assertEqual((imapconn.selected_mailbox, imapconn.selected_readonly), ('INBOX', True))
+
+        # Keepalives only happen once the connection was unused for long enough
+        manager.keepalive_interval = 1
+        manager.last_activity = time.time() - 2
+        self.assertEqual(manager.keepalive().code, True)
+        self.assertFalse(manager.keepalive_due())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 sw=4 et
+
+from tabellarius.filter_program import AhoCorasick, CompiledPattern, DecisionCache, FilterProgram, HeaderMatcher
+from tabellarius.mail_filter import MailFilter
+from tabellarius.misc import ConfigParser, Helper
+
+from .tabellarius_test import TabellariusTest
+
+
+class FilterProgramTest(TabellariusTest):
+    def test_aho_corasick(self):
+        automaton = AhoCorasick({'he': 1, 'she': 2, 'his': 3, 'hers': 4, 'e': 5})
+        self.assertEqual(automaton.search('ushers'), {1, 2, 4, 5})
+        self.assertEqual(automaton.search('this'), {3})
+        self.assertEqual(automaton.search('xyz'), set())
+        self.assertEqual(automaton.search(''), set())
+        self.assertEqual(AhoCorasick({'': 1, 'a': 2}).search('b'), {1})
+
+    def test_header_matcher(self):
+        patterns = ['newsletter', '^re:', '@example.com', '(a)\\1', '(?s)foo.bar', '[unclosed', '.*']
+        matcher = HeaderMatcher(dict(enumerate(CompiledPattern(pattern) for pattern in patterns)))
+        self.assertEqual(len(matcher.fallback), 2)
+
+        self.assertEqual(matcher.match('re: weekly newsletter'), {0, 1, 6})
+        self.assertEqual(matcher.match('bob@example.com'), {2, 6})
+        self.assertEqual(matcher.match('@examplexcom'), {2, 6})
+        self.assertEqual(matcher.match('bob@examplexcom'), {6})
+        self.assertEqual(matcher.match('aa foo'), {3, 6})
+        self.assertEqual(matcher.match('foo\nbar [unclosed'), {4, 5, 6})
+        self.assertEqual(matcher.match(''), set())
+
+    def test_compiled_pattern(self):
+        pattern = CompiledPattern('^.*@Example.(com|net)$')
+        self.assertEqual(pattern.pattern, '^.*@example.(com|net)$')
+        self.assertTrue(pattern.match('foo@example.net'))
+        self.assertFalse(pattern.match('foo@example.org'))
+        self.assertFalse(pattern.match(''))
+        self.assertFalse(pattern.match(None))
+
+        # Invalid regular expressions only matter if the pattern isn't found literally
+        pattern = CompiledPattern('[unclosed')
+        self.assertIsNone(pattern.regex)
+        self.assertTrue(pattern.match('an [unclosed bracket'))
+        self.assertRaises(Exception, pattern.match, 'something else')
+
+    def test_first_match(self):
+        filters = {
+            '10_or': {'commands': [], 'rules': [{'or': [{'subject': ['newsletter']}, {'from': ['@example.com']}]}]},
+            '2_and': {'commands': [], 'rules': [{'and': [{'from': ['@example.com']}, {'subject': ['^invoice [0-9]+$']}]}]},
+            '30_empty': {'commands': [], 'rules': [{'and': []}, {'or': []}]},
+            '40_list': {'commands': [], 'rules': [{'or': [{'received': ['mx.example.org']}]}]},
+        }
+        program = FilterProgram(filters)
+        self.assertEqual([compiled.name for compiled in program.filters], ['2_and', '10_or', '30_empty', '40_list'])
+        self.assertEqual(program['10_or'].config, filters['10_or'])
+
+        for headers, filter_name in [({'Subject': 'Weekly NEWSLETTER'}, '10_or'),
+                                     ({'From': '<bob@example.com>', 'Subject': 'Invoice 42'}, '2_and'),
+                                     ({'From': '<bob@example.com>', 'Subject': 'Hello'}, '10_or'),
+                                     ({'From': '<bob@example.org>', 'Received': ['from mx.example.com', 'from mx.example.org']}, '40_list'),
+                                     ({'From': '<bob@example.org>', 'Subject': 'Hello'}, None)]:
+            compiled = program.first_match(self.create_email(headers=headers))
+            self.assertEqual(compiled.name if compiled else None, filter_name)
+
+        # Patterns shared by several filters are matched once
+        program = FilterProgram({'1_a': {'commands': [], 'rules': [{'and': [{'subject': ['hello']}, {'from': ['@example.org']}]}]},
+                                 '2_b': {'commands': [], 'rules': [{'or': [{'Subject': ['Hello', '[unclosed']}]}]}})
+        self.assertLess(program['1_a'].rows[0][0][1][0].pattern_ids, program['2_b'].rows[0][0][1][0].pattern_ids)
+        compiled = program.first_match(self.create_email(headers={'From': '<bob@example.com>', 'Subject': 'Hello'}))
+        self.assertEqual(compiled.name, '2_b')
+
+        self.assertEqual(FilterProgram(None).filters, [])
+        self.assertRaises(NotImplementedError, FilterProgram, {'xor': {'commands': [], 'rules': [{'xor': []}]}})
+
+    def test_header_index(self):
+        filters = {
+            '1_list': {'commands': [], 'rules': [{'and': [{'list-id': ['announce']}, {'subject': ['release']}]}]},
+            '2_from': {'commands': [], 'rules': [{'or': [{'from': ['@example.com']}]}, {'and': [{'x-spam': ['yes']}, {'subject': ['[bad']}]}]},
+            '3_empty': {'commands': [], 'rules': [{'and': []}]},
+        }
+        program = FilterProgram(filters)
+        self.assertEqual(program.filters_by_header, {'list-id': [0], 'subject': [0, 1], 'from': [1], 'x-spam': [1]})
+        self.assertEqual(program['1_list'].rows[0][0][2], frozenset(['list-id', 'subject']))
+        # Groups with invalid patterns are always evaluated
+        self.assertEqual(program['2_from'].rows[1][0][2], frozenset())
+
+        mail = self.create_email(headers={'From': '<bob@example.org>', 'Subject': 'New release'})
+        self.assertEqual(program.get_header_names(mail), frozenset(['from', 'subject']))
+        self.assertIsNone(program.first_match(mail))
+        self.assertFalse(program['1_list'].match(mail, header_names=program.get_header_names(mail)))
+        self.assertTrue(program['1_list'].match(self.create_email(headers={'List-Id': '<announce.example.org>', 'Subject': 'New release'})))
+
+        mail = self.create_email(headers={'From': '<bob@example.com>', 'List-Id': '<announce.example.org>', 'Subject': 'New release'})
+        self.assertEqual(program.first_match(mail).name, '1_list')
+        mail = self.create_email(headers={'From': '<bob@example.org>', 'X-Spam': 'yes', 'Subject': 'Spam'})
+        self.assertRaises(Exception, program.first_match, mail)
+
+    def test_decision_cache(self):
+        filters = {
+            '1_list': {'commands': [], 'rules': [{'or': [{'list-id': ['announce']}]}]},
+            '2_from': {'commands': [], 'rules': [{'or': [{'from': ['@example.com']}]}]},
+        }
+        cache = DecisionCache(max_size=2)
+        program = FilterProgram(filters, cache=cache)
+        self.assertEqual(program.header_names, ['from', 'list-id'])
+
+        # Only the headers the filters look at make up the fingerprint
+        mail = self.create_email(headers={'From': '<bob@example.com>', 'Subject': 'One'})
+        self.assertEqual(program.get_fingerprint(mail), program.get_fingerprint(self.create_email(headers={'From': '<bob@example.com>', 'Subject': 'Two'})))
+        self.assertNotEqual(program.get_fingerprint(mail), program.get_fingerprint(self.create_email(headers={'From': '<eve@example.com>'})))
+
+        self.assertEqual(program.first_match(mail).name, '2_from')
+        self.assertEqual(program.first_match(mail).name, '2_from')
+        self.assertIsNone(program.first_match(self.create_email(headers={'From': '<bob@example.org>'})))
+        self.assertIsNone(program.first_match(self.create_email(headers={'From': '<bob@example.org>'})))
+        self.assertEqual((cache.hits, cache.misses, len(cache.entries)), (2, 2, 2))
+
+        # The least recently used decision is evicted
+        program.first_match(self.create_email(headers={'From': '<bob@example.net>'}))
+        self.assertEqual(len(cache.entries), 2)
+        self.assertNotIn(program.get_fingerprint(mail), cache.entries)
+
+        # Changed filters invalidate all decisions
+        filters['2_from']['rules'][0]['or'][0]['from'] = ['@example.org']
+        program = FilterProgram(filters, cache=cache)
+        self.assertIsNone(program.first_match(mail))
+        self.assertEqual(program.first_match(self.create_email(headers={'From': '<bob@example.org>'})).name, '2_from')
+        self.assertEqual((cache.hits, cache.misses, len(cache.entries)), (2, 5, 2))
+
+    def test_mail_filter_equivalence(self):
+        config = ConfigParser().load('tests/configs/integration/valid/')
+        mails = [self.create_email(headers=dict(mail.items())) for mail in self.parse_message_files().values()]
+
+        for filters in config.get('filters').values():
+            program = FilterProgram(filters)
+            for mail in mails:
+                match = None
+                for filter_name, filter_settings in Helper().sort_dict(filters).items():
+                    if MailFilter(logger=self.logger, imap=None, mail=mail, config=filter_settings, mailbox='PreInbox', test=True).check_rules_match():
+                        match = filter_name
+                        break
+
+                compiled = program.first_match(mail)
+                self.assertEqual(compiled.name if compiled else None, match)
@@ -4,6 +4,7 @@
 import datetime
 import imapclient.fixed_offset
 
+from tabellarius.capabilities import Feature
 from tabellarius.imap import IMAP
 
 from .tabellarius_test import TabellariusTest
@@ -84,6 +85,29 @@ class IMAPTest(TabellariusTest):
             self.assertEqual(imapconn.process_error(exception=e), (False, '\'test\''))
             self.assertIsInstance(imapconn.process_error(exception=e, simple_return=True), KeyError)
 
+    def test_idle(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        imapconn2 = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+        self.assertEqual(imapconn2.connect(), (True, 'Logged in'))
+
+        self.assertTrue(imapconn.has_capability('IDLE'))
+        self.assertTrue(imapconn.has_capability(Feature.IDLE))
+        self.assertFalse(imapconn.has_capability('DOESNOTEXIST'))
+
+        self.assertTrue(imapconn.idle_start(mailbox='INBOX').code)
+        self.assertEqual(imapconn.idle_check(timeout=0), (True, []))
+
+        self.assertEqual(imapconn2.add_mail(mailbox='INBOX', message=self.create_email()), (True, 1))
+        result = imapconn.idle_check(timeout=5)
+        self.assertTrue(result.code)
+        self.assertIn((1, b'EXISTS'), result.data)
+        self.assertTrue(imapconn.idle_done().code)
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+        self.assertEqual(imapconn2.disconnect(), (True, 'Logging out'))
+
     def test_list_mailboxes(self):
         username, password = self.create_imap_user()
         imapconn = self.create_basic_imap_object(username, password)
@@ -118,6 +142,31 @@ class IMAPTest(TabellariusTest):
 
         self.assertEqual(imapconn.disconnect(), IMAP.Retval(True, 'Logging out'))
 
+    def test_select_mailbox_cached(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), IMAP.Retval(True, 'Logged in'))
+
+        # Read-only commands EXAMINE the mailbox
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX'), IMAP.Retval(True, []))
+        self.assertEqual((imapconn.selected_mailbox, imapconn.selected_readonly), ('INBOX', True))
+
+        # Others need a SELECT, which is sufficient for read-only commands afterwards
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, 1))
+        self.assertEqual(imapconn.set_mailflags(uids=[1], mailbox='INBOX', flags=['\\Seen']), (True, {1: ['\\Seen']}))
+        self.assertEqual((imapconn.selected_mailbox, imapconn.selected_readonly), ('INBOX', False))
+        self.assertEqual(imapconn.get_mailflags(uids=[1], mailbox='INBOX'), (True, {1: ['\\Seen']}))
+        self.assertEqual((imapconn.selected_mailbox, imapconn.selected_readonly), ('INBOX', False))
+
+        state = imapconn.selected_state
+        self.assertIs(imapconn.select_mailbox(mailbox='INBOX').data, state)
+        self.assertIsNot(imapconn.select_mailbox(mailbox='INBOX', force=True).data, state)
+
+        self.assertFalse(imapconn.select_mailbox(mailbox='DoesNotExist').code)
+        self.assertIsNone(imapconn.selected_mailbox)
+
+        self.assertEqual(imapconn.disconnect(), IMAP.Retval(True, 'Logging out'))
+
     def test_select_mailbox_nonexisting_mailbox(self):
         username, password = self.create_imap_user()
         imapconn = self.create_basic_imap_object(username, password)
@@ -170,6 +219,21 @@ class IMAPTest(TabellariusTest):
 
         self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
 
+    def test_search_mail_min_uid(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), IMAP.Retval(True, 'Logged in'))
+
+        self.assertTrue(imapconn.add_mail(mailbox='INBOX', message=self.create_email(), flags=['\\Seen']).code)
+        self.assertTrue(imapconn.add_mail(mailbox='INBOX', message=self.create_email()).code)
+        self.assertTrue(imapconn.add_mail(mailbox='INBOX', message=self.create_email(), flags=['\\Seen']).code)
+
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX', criteria='ALL', min_uid=2), IMAP.Retval(True, [2, 3]))
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX', criteria='SEEN', min_uid=2), IMAP.Retval(True, [3]))
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX', criteria='ALL', min_uid=4), IMAP.Retval(True, []))
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
     def test_search_mail_errors(self):
         username, password = self.create_imap_user()
         imapconn = self.create_basic_imap_object(username, password)
@@ -214,6 +278,131 @@ class IMAPTest(TabellariusTest):
 
         self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
 
+    def test_fetch_mails_batched(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        imapconn.fetch_chunk_size = 2
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        for uid in range(1, 6):
+            self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, uid))
+
+        result = imapconn.fetch_mails(uids=[1, 2, 3, 5, 1337], mailbox='INBOX')
+        self.assertTrue(result.code)
+        self.assertEqual(list(result.data.keys()), [1, 2, 3, 5])
+        self.assertEqual(result.data[5].get_header('Subject'), 'Testmäil')
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
+    def test_fetch_mails_parallel(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        imapconn.fetch_chunk_size = 2
+        imapconn.fetch_connections = 3
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        mails = {}
+        for uid in range(1, 8):
+            mails[uid] = self.create_email(reset_message_id=True)
+            self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=mails[uid]), (True, uid))
+        imapconn.message_id_index.clear()
+
+        result = imapconn.fetch_mails(uids=list(range(1, 8)), mailbox='INBOX', headers=['subject'])
+        self.assertTrue(result.code)
+        self.assertEqual(sorted(result.data.keys()), list(range(1, 8)))
+        self.assertEqual(len(imapconn.fetch_pool), 2)
+        self.assertEqual(imapconn.message_id_index['INBOX'], dict((mail.get_message_id(), uid) for uid, mail in mails.items()))
+
+        # Small fetches use the primary connection only
+        self.assertEqual(list(imapconn.fetch_mails(uids=[1], mailbox='INBOX').data.keys()), [1])
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+        self.assertEqual(imapconn.fetch_pool, [])
+
+    def test_stream_mails(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        imapconn.max_mails_in_flight = 2
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        for uid in range(1, 6):
+            self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, uid))
+
+        batches = [result.data for result in imapconn.stream_mails(uids=list(range(1, 6)), mailbox='INBOX', headers=['subject'])]
+        self.assertEqual([sorted(mails.keys()) for mails in batches], [[1, 2], [3, 4], [5]])
+        self.assertEqual(batches[0][1].get_header('Subject'), 'Testmäil')
+
+        # Whole mails are split by size as well
+        sizes = imapconn.get_mail_sizes(uids=list(range(1, 6)), mailbox='INBOX').data
+        self.assertEqual(sorted(sizes.keys()), list(range(1, 6)))
+        imapconn.max_mails_in_flight = None
+        imapconn.max_bytes_in_flight = sizes[1] + sizes[2]
+        batches = [result.data for result in imapconn.stream_mails(uids=list(range(1, 6)), mailbox='INBOX')]
+        self.assertEqual([sorted(mails.keys()) for mails in batches], [[1, 2], [3, 4], [5]])
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
+    def test_pipeline(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        for uid in range(1, 5):
+            self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, uid))
+
+        self.assertEqual(imapconn.set_mailflags_many(mailbox='INBOX', flag_sets={('\\Flagged',): [1, 2], ('\\Seen', '\\Answered'): [4]}),
+                         (True, None))
+        self.assertEqual(imapconn.get_mailflags(uids=[1, 2, 3, 4], mailbox='INBOX'),
+                         (True, {1: ['\\Flagged'], 2: ['\\Flagged'], 3: [], 4: ['\\Answered', '\\Seen']}))
+
+        result = imapconn.pipeline([('FETCH', ['1:2', '(FLAGS)']), ('FETCH', ['4', '(FLAGS)'])])
+        self.assertTrue(result.code)
+        self.assertEqual(sorted(result.data.keys()), [1, 2, 4])
+        self.assertEqual(result.data[1][b'FLAGS'], (b'\\Flagged',))
+
+        # A failing command doesn't leave the other responses on the wire
+        self.assertFalse(imapconn.pipeline([('STORE', ['1', 'FLAGS.SILENT', '(\\Invalid)']), ('FETCH', ['2', '(FLAGS)'])]).code)
+        self.assertTrue(imapconn.noop().data)
+
+        with self.assertRaises(ValueError):
+            imapconn.pipeline([('SEARCH', ['ALL'])])
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
+    def test_fetch_mails_headers_only(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        mail = self.create_email(headers={'X-Custom': 'foo'}, reset_message_id=True)
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=mail), (True, 1))
+
+        fetched = imapconn.fetch_mails(uids=[1], mailbox='INBOX', headers=['subject']).data[1]
+        self.assertEqual(fetched.get_header('Subject'), 'Testmäil')
+        self.assertEqual(fetched.get_message_id(), mail.get_message_id())
+        self.assertIsNone(fetched.get_header('X-Custom'))
+        self.assertEqual(fetched.get_body(), '')
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
+    def test_condstore(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+        self.assertTrue(imapconn.condstore)
+
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, 1))
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, 2))
+        highestmodseq = imapconn.select_mailbox(mailbox='INBOX').data['HIGHESTMODSEQ']
+
+        criteria = 'MODSEQ {} ALL'.format(highestmodseq + 1)
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX', criteria=criteria), (True, []))
+
+        imapconn.add_mailflags(uids=[2], mailbox='INBOX', flags=['\\Seen'])
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX', criteria=criteria), (True, [2]))
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
     def test_get_and_set_mailflags(self):
         username, password = self.create_imap_user()
         imapconn = self.create_basic_imap_object(username, password)
@@ -354,6 +543,61 @@ class IMAPTest(TabellariusTest):
 
         self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
 
+    def test_copy_mails_multiple(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        self.assertEqual(imapconn.add_mail(mailbox='Trash', message=self.create_email(reset_message_id=True)), (True, 1))
+
+        message_ids = []
+        for uid in range(1, 4):
+            mail = self.create_email(headers={'Message-Id': '<copy_{0}_{1}@example.com>'.format(uid, username)})
+            self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=mail), (True, uid))
+            message_ids.append(mail.get_message_id())
+
+        # The destination UIDs have to be returned in the order of the given Message-Ids
+        self.assertEqual(imapconn.copy_mails(message_ids=[message_ids[2], message_ids[0]], source='INBOX', destination='Trash'), (True, [3, 2]))
+        self.assertEqual(imapconn.fetch_mails(uids=[2], mailbox='Trash').data[2].get_message_id(), message_ids[0])
+        self.assertEqual(imapconn.fetch_mails(uids=[3], mailbox='Trash').data[3].get_message_id(), message_ids[2])
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
+    def test_copy_mails_by_uid(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        mail = self.create_email(reset_message_id=True)
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=mail), (True, 1))
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email(reset_message_id=True)), (True, 2))
+        self.assertEqual(imapconn.message_id_index['INBOX'][mail.get_message_id()], 1)
+
+        # Moved mails are looked up in the index and get indexed in their new mailbox
+        self.assertEqual(imapconn.move_mail(uids=[1], source='INBOX', destination='Trash'), (True, [1]))
+        self.assertNotIn(mail.get_message_id(), imapconn.message_id_index['INBOX'])
+        self.assertEqual(imapconn.message_id_index['Trash'][mail.get_message_id()], 1)
+        self.assertEqual(imapconn.move_mail(message_ids=[mail.get_message_id()], source='Trash', destination='INBOX'), (True, [3]))
+
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX'), (True, [2, 3]))
+        self.assertEqual(imapconn.search_mails(mailbox='Trash'), (True, []))
+
+        # The index of each mailbox is bounded, the least recently used mails are forgotten first
+        imapconn.message_id_index_size = 1
+        self.assertEqual(imapconn.move_mail(uids=[2], source='INBOX', destination='Trash'), (True, [2]))
+        self.assertEqual(imapconn.move_mail(uids=[3], source='INBOX', destination='Trash'), (True, [3]))
+        self.assertEqual(list(imapconn.message_id_index['Trash'].values()), [3])
+
+        # Mails moved away by another client are not looked up in the stale index
+        otherconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(otherconn.connect(), (True, 'Logged in'))
+        self.assertEqual(otherconn.move_mail(uids=[3], source='Trash', destination='Other'), (True, [1]))
+        self.assertFalse(imapconn.move_mail(message_ids=[mail.get_message_id()], source='Trash', destination='INBOX').code)
+        self.assertNotIn(mail.get_message_id(), imapconn.message_id_index['Trash'])
+        self.assertEqual(otherconn.disconnect(), (True, 'Logging out'))
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
     def test_copy_mails_errors(self):
         username, password = self.create_imap_user()
         imapconn = self.create_basic_imap_object(username, password)
@@ -431,6 +675,36 @@ class IMAPTest(TabellariusTest):
 
         self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
 
+    def test_mailbox_cache(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        imapconn2 = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+        self.assertEqual(imapconn2.connect(), (True, 'Logged in'))
+
+        self.assertIn('INBOX', imapconn.mailbox_cache)
+        self.assertEqual(imapconn.mailbox_exists(mailbox='inbox'), (True, True))
+
+        # Mailboxes created by others are unknown until the cache gets refreshed
+        self.assertEqual(imapconn2.create_mailbox(mailbox='Cached'), (True, True))
+        self.assertEqual(imapconn.mailbox_exists(mailbox='Cached'), (True, False))
+        self.assertTrue(imapconn.refresh_mailbox_cache().code)
+        self.assertEqual(imapconn.mailbox_exists(mailbox='Cached'), (True, True))
+
+        # Creating a mailbox that another client created already refreshes the cache
+        self.assertEqual(imapconn2.create_mailbox(mailbox='Cached2'), (True, True))
+        self.assertEqual(imapconn.mailbox_exists(mailbox='Cached2'), (True, False))
+        self.assertEqual(imapconn.create_mailbox(mailbox='Cached2'), (True, False))
+        self.assertEqual(imapconn.mailbox_exists(mailbox='Cached2'), (True, True))
+
+        # The cache is invalidated if the server tells us that it is outdated
+        self.assertFalse(imapconn.add_mail(mailbox='DoesNotExist', message=self.create_email()).code)
+        self.assertIsNone(imapconn.mailbox_cache)
+        self.assertEqual(imapconn.mailbox_exists(mailbox='Cached'), (True, True))
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+        self.assertEqual(imapconn2.disconnect(), (True, 'Logging out'))
+
     def test_delete_mails_and_expunge(self):
         username, password = self.create_imap_user()
         imapconn = self.create_basic_imap_object(username, password)
@@ -467,6 +741,48 @@ class IMAPTest(TabellariusTest):
 
         self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
 
+    def test_expunge_uids(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, 1))
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, 2))
+
+        self.assertTrue(imapconn.delete_mails(uids=[1, 2], mailbox='INBOX').code)
+        self.assertEqual(imapconn.expunge(mailbox='INBOX', uids=[1]), (True, True))
+
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX'), (True, [2]))
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
+    def test_expunge_end_of_cycle(self):
+        username, password = self.create_imap_user()
+        imapconn = self.create_basic_imap_object(username, password)
+        imapconn.expunge_policy = 'end_of_cycle'
+        self.assertEqual(imapconn.connect(), (True, 'Logged in'))
+
+        # Force COPY/STORE, MOVE doesn't leave anything to expunge
+        has_capability = imapconn.has_capability
+        imapconn.has_capability = lambda capability: capability != Feature.MOVE and has_capability(capability)
+
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, 1))
+        self.assertEqual(imapconn.add_mail(mailbox='INBOX', message=self.create_email()), (True, 2))
+
+        self.assertEqual(imapconn.move_mail(uids=[1], source='INBOX', destination='Trash'), (True, [1]))
+        self.assertEqual(imapconn.move_mail(uids=[2], source='INBOX', destination='Trash'), (True, [2]))
+        self.assertEqual(imapconn.pending_expunges, {'INBOX': [1, 2]})
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX', criteria='DELETED'), (True, [1, 2]))
+
+        self.assertEqual(imapconn.flush_expunges(), (True, {'INBOX': [1, 2]}))
+        self.assertEqual(imapconn.pending_expunges, {})
+        self.assertEqual(imapconn.search_mails(mailbox='INBOX'), (True, []))
+
+        with self.assertRaises(ValueError):
+            IMAP(logger=self.logger, username=username, password=password, expunge_policy='never')
+
+        self.assertEqual(imapconn.disconnect(), (True, 'Logging out'))
+
     def test_delete_mails_and_expunge_errors(self):
         username, password = self.create_imap_user()
         imapconn = self.create_basic_imap_object(username, password)
@@ -1,12 +1,39 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 sw=4 et
 
+import email
+
+from tabellarius.mail import Mail
 from tabellarius.misc import Helper
 
 from .tabellarius_test import TabellariusTest
 
 
 class MailTest(TabellariusTest):
+    def test_lazy_decoding(self):
+        raw_mail = ('Received: from a\nReceived: from b\nSubject: =?utf-8?q?H=C3=A4llo?=\nMessage-Id: <lazy@example.com>\n'
+                    'Content-Type: text/plain; charset=utf-8\n\nB\xf6dy\n').encode('utf-8')
+        mail = Mail(logger=self.logger, mail_native=email.message_from_bytes(raw_mail))
+
+        self.assertEqual(mail.get_header_names(), ['Received', 'Subject', 'Message-Id', 'Content-Type'])
+        self.assertEqual(mail._undecoded_headers, {'received': ['Received'], 'subject': ['Subject'], 'message-id': ['Message-Id'],
+                                                   'content-type': ['Content-Type']})
+        self.assertTrue(mail._undecoded_body)
+
+        self.assertEqual(mail.get_header('subject'), 'Hällo')
+        self.assertEqual(mail.get_header('Received'), ['from a', 'from b'])
+        self.assertNotIn('subject', mail._undecoded_headers)
+        self.assertIsNone(mail.get_header('X-Missing'))
+
+        # Set headers aren't overwritten by decoding
+        mail.set_header('Content-Type', 'text/html')
+        self.assertEqual(mail.get_headers()['content-type'], 'text/html')
+        self.assertEqual(mail._undecoded_headers, {})
+        self.assertEqual(mail.get_message_id(), '<lazy@example.com>')
+
+        self.assertEqual(mail.get_body(), 'Bödy\n')
+        self.assertFalse(mail._undecoded_body)
+
     def test_set_header(self):
         username, password = self.create_imap_user()
         imapconn = self.create_basic_imap_object(username, password)
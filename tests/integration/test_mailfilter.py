@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 sw=4 et
 
+from tabellarius.action_plan import ActionPlan
 from tabellarius.mail_filter import MailFilter
 from tabellarius.misc import ConfigParser, Helper
 
@@ -30,6 +31,34 @@ class MailFilterTest(TabellariusTest):
         self.assertFalse(mailfilter.check_match('foo', '^fo+!$'))
         self.assertTrue(mailfilter.check_match('UPPERCASE', '^Uppercase$'))
 
+    def test_get_header_names(self):
+        cfg_parser = ConfigParser()
+        config = cfg_parser.load('tests/configs/integration/valid/')
+
+        self.assertEqual(MailFilter.get_header_names(config.get('filters').get('local_imap_server')), ['from', 'subject', 'to'])
+        self.assertIn('x-custom-mail-id', MailFilter.get_header_names(config.get('filters').get('test')))
+        self.assertIsNone(MailFilter.get_header_names({'forward': {'commands': [{'type': 'forward'}], 'rules': []}}))
+
+    def test_check_rules_match_plan(self):
+        cfg_parser = ConfigParser()
+        config = cfg_parser.load('tests/configs/integration/valid/')
+
+        plan = ActionPlan(logger=self.logger, mailbox='PreInbox')
+        mail = self.create_email(headers={'From': 'Arnold <arnold@arnoldbechtoldt.com>', 'Message-Id': '<plan@example.com>'})
+        mailfilter = MailFilter(logger=self.logger,
+                                imap=None,
+                                mail=mail,
+                                config=config.get('filters').get('test').get('arnold'),
+                                mailbox='PreInbox',
+                                plan=plan)
+
+        self.assertTrue(mailfilter.check_rules_match())
+        self.assertEqual(plan.moves, {('w00t', ('\\Flagged',), ()): {'uids': [], 'message_ids': ['<plan@example.com>']}})
+
+        mail.uid = 42
+        self.assertTrue(mailfilter.check_rules_match())
+        self.assertEqual(plan.moves, {('w00t', ('\\Flagged',), ()): {'uids': [42], 'message_ids': ['<plan@example.com>']}})
+
     def test_mail_filter_matching(self):
         username, password = self.create_imap_user()
         native_test_emails = self.parse_message_files()
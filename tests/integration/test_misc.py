@@ -3,7 +3,7 @@
 
 import collections
 
-from tabellarius.misc import CaseInsensitiveDict, ConfigParser, Helper
+from tabellarius.misc import AccountLoggerAdapter, CaseInsensitiveDict, ConfigParser, Helper
 
 from .tabellarius_test import TabellariusTest
 
@@ -13,6 +13,31 @@ class HelperTest(TabellariusTest):
         import logging
         self.assertIsInstance(Helper().create_logger('program_name', {}), logging.Logger)
 
+    def test_uids_to_sequence_set(self):
+        self.assertEqual(Helper().uids_to_sequence_set([1]), '1')
+        self.assertEqual(Helper().uids_to_sequence_set([3, 1, 2]), '1:3')
+        self.assertEqual(Helper().uids_to_sequence_set(list(range(1, 501)) + [502] + list(range(510, 801))), '1:500,502,510:800')
+        self.assertEqual(Helper().uids_to_sequence_set([5, 5, 7]), '5,7')
+
+    def test_sequence_set_to_uids(self):
+        self.assertEqual(Helper().sequence_set_to_uids('1'), [1])
+        self.assertEqual(Helper().sequence_set_to_uids(b'1:3,5'), [1, 2, 3, 5])
+        self.assertEqual(Helper().sequence_set_to_uids('7:5'), [5, 6, 7])
+        self.assertEqual(Helper().sequence_set_to_uids(Helper().uids_to_sequence_set([1, 2, 3, 9, 11, 12])), [1, 2, 3, 9, 11, 12])
+
+    def test_chunks(self):
+        self.assertEqual(list(Helper().chunks([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+        self.assertEqual(list(Helper().chunks([], 2)), [])
+
+    def test_batches(self):
+        self.assertEqual(list(Helper().batches([1, 2, 3, 4, 5])), [[1, 2, 3, 4, 5]])
+        self.assertEqual(list(Helper().batches([1, 2, 3, 4, 5], max_items=2)), [[1, 2], [3, 4], [5]])
+
+        sizes = {1: 10, 2: 10, 3: 50, 4: 5, 5: 5}
+        self.assertEqual(list(Helper().batches([1, 2, 3, 4, 5], sizes=sizes, max_size=20)), [[1, 2], [3], [4, 5]])
+        self.assertEqual(list(Helper().batches([1, 2, 3, 4, 5], max_items=1, sizes=sizes, max_size=20)), [[1], [2], [3], [4], [5]])
+        self.assertEqual(list(Helper().batches([])), [])
+
 
 class ConfigParserTest(TabellariusTest):
     def test_configparser_valid(self):
@@ -71,3 +96,14 @@ class CaseInsensitiveDictTest(TabellariusTest):
 
         del header_insensitive['To']
         self.assertNotIn('To', header_insensitive)
+
+
+class AccountLoggerAdapterTest(TabellariusTest):
+    def test_account_logger_adapter(self):
+        import logging
+        logger = AccountLoggerAdapter(logging.getLogger('tabellarius_test'), {'account': 'test_account'})
+
+        with self.assertLogs('tabellarius_test', level='INFO') as logs:
+            logger.info('%s mails sorted', 3)
+        self.assertEqual(logs.records[0].getMessage(), '[test_account] 3 mails sorted')
+        self.assertEqual(logs.records[0].account, 'test_account')